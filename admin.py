@@ -1,13 +1,9 @@
-import re, urllib2, datetime
+import re
 from django.contrib import admin
 from django import forms
 from django.conf import settings
-from models import XPath, ValidValue, Rule, RuleSet, ValidValuesSet, ValidationJob, ValidationReport, ValidationReportItem, ValidationSet
+from models import XPath, ValidValue, Rule, RuleSet, ValidValuesSet, ValidationJob, ValidationReport, ValidationReportItem, ValidationSet, LinkCheckResult
 from django.core.exceptions import ValidationError
-from BeautifulSoup import BeautifulSoup
-from urlparse import urljoin, urlparse, ParseResult, urlunparse
-from xmlvalidator import ValidationException
-from lxml import etree
 
 class RuleInline(admin.TabularInline):
     model = RuleSet.rules.through
@@ -107,165 +103,48 @@ class RuleSetAdmin(admin.ModelAdmin):
     inlines = [RuleInline]
 
 class ValidationJobAdmin(admin.ModelAdmin):
-    list_display = ['name', 'url', 'set_link', 'last_result', 'last_report_link']
-    list_filter = ['set', 'last_result']
+    list_display = ['name', 'url', 'set_link', 'last_result', 'status', 'last_report_link']
+    list_filter = ['set', 'last_result', 'status']
     search_fields = ['url', 'name']
     
+    def queryset(self, request):
+        # last_report_link and set_link would otherwise cost two queries per row
+        return super(ValidationJobAdmin, self).queryset(request).select_related('latest_report', 'set')
+    
     def save_model(self, request, obj, form, change):
+        # A different record should never be mistaken for an unchanged one
+        if 'url' in form.changed_data:
+            obj.content_hash = obj.etag = obj.last_modified = obj.ruleset_signature = ''
+            obj.ruleset_version = None
         obj.save()
         
-        result, report = obj.ruleset.xml_validate(obj.url)
-        obj.last_result = result
-        obj.save()
-        
-        new_report = obj.validationreport_set.create()
-        new_report.save()
-        
-        for item in report:
-            new_item = new_report.validationreportitem_set.create(item=item)
-            new_item.save()
-            
-        if len(new_report.validationreportitem_set.all()) == 0:
-            new_item = new_report.validationreportitem_set.create(item='Passed Validation Without Errors')
-            new_item.save()
+    def save_related(self, request, form, formsets, change):
+        super(ValidationJobAdmin, self).save_related(request, form, formsets, change)
+        # Validation happens in a background worker once the rule sets are saved too. See jobqueue.py
+        form.instance.enqueue()
     
 class ValidationReportAdmin(admin.ModelAdmin):
-    readonly_fields = ['job', 'run_date']
+    readonly_fields = ['job', 'ruleset', 'run_date', 'passed', 'items_display']
     inlines = [ValidationReportItemAdmin]
 
-def string_is_getrecords(response_string):
-    result = False
-    
-    # Can lxml parse it?
-    try:
-        doc = etree.fromstring(response_string)
-    except Exception, err:
-        # lxml can't parse it. Not a valid csw response at least...
-        pass
-    else:
-        if doc.tag == '{http://www.opengis.net/cat/csw/2.0.2}GetRecordsResponse':
-            result = True
-    return result
-
-def construct_recordbyid_request(recordId, parsed_csw_url):
-    query = 'request=GetRecordById&service=CSW&Id=' + recordId + '&elementSetName=full&outputSchema=http://www.isotc211.org/2005/gmd'
-    url_builder = ParseResult(scheme=parsed_csw_url.scheme, 
-                              netloc=parsed_csw_url.netloc, 
-                              path=parsed_csw_url.path, 
-                              params='', 
-                              query=query, 
-                              fragment='')
-    return urlunparse(url_builder)
-    
-def file_list_from_csw(getrecords_string, url):
-    '''
-    Given a string representing a csw:GetRecords response
-    Returns a list of tuples: (url to get an individual record, error message)
-    '''
-    
-    doc = etree.fromstring(getrecords_string)
-    ns = {'csw': 'http://www.opengis.net/cat/csw/2.0.2',
-          'dc': 'http://purl.org/dc/elements/1.1/'} 
-    # Get a list of records. Requires csw:BriefRecords
-    records = doc.xpath('//csw:BriefRecord', namespaces=ns)
-    
-    if len(records) == 0:
-        # There were no brief records. Maybe the request is bad, maybe there are just no records.
-        error_message = 'No csw:BriefRecord elements found in csw:GetRecordsResponse.'
-        return [('', error_message)]
-    
-    else:
-        csw = urlparse(url)
-        file_list = list()
-        for record in records:
-            # Finding the FileID might get tricky
-            identifiers = record.xpath('dc:identifier', namespaces=ns)
-            if len(identifiers) == 1:
-                recordId = identifiers[0].text
-                file_list.append((construct_recordbyid_request(recordId, csw), ''))
-            else:
-                # Find the ESRI-style file ID
-                fileId = record.xpath('dc:identifier[@scheme="urn:x-esri:specification:ServiceType:ArcIMS:Metadata:FileID"]', namespaces=ns)
-                if len(fileId) == 1: 
-                    recordId = fileId[0].text
-                    file_list.append((construct_recordbyid_request(recordId, csw), ''))
-                else:
-                    # Could look for other-style file IDs here
-                    file_list.append(('','Could not find File Identifier in csw:BriefRecord.'))
-        
-        return file_list
-
-def file_list_from_waf(response_string, url):
-    '''
-    Given a string representing a web-accessible folder's HTML
-    Returns a list of tuples: (url to get an individual record, error message)
-    '''
-    #Soupify
-    soup = BeautifulSoup(response_string)
-    
-    file_list = list()
-    
-    # Loop through all the links to XML files
-    tags = soup.findAll('a', href=re.compile('.+\.xml'))
-    for tag in tags:
-        # Generate an absolute URL to the XML file
-        file_list.append((urljoin(url, tag['href']), ''))
-        
-    return file_list
-                        
 class ValidationSetAdmin(admin.ModelAdmin):
     #inlines = [ValidationJobInline]
+    list_display = ['name', 'url', 'status', 'progress', 'finished_at']
     
-    def save_model(self, request, obj, form, change):
-        # Save the Validation Set so we know we can create related objects from it
-        obj.save()
-        
-        # Get the content at the given URL
-        req = urllib2.Request(obj.url)
-        response = urllib2.urlopen(req).read()
-        
-        if string_is_getrecords(response):
-            files = file_list_from_csw(response, obj.url)
-        else:
-            files = file_list_from_waf(response, obj.url)
-            
-        # Now Validate them
-        for file in files:
-            if file[0] != '':    
-                try:
-                    result, report = obj.ruleset.xml_validate(file[0])
-                except ValidationException, err:
-                    result = False
-                    report = ['Validation Error: '  + err.msg]
-            else:
-                result = False
-                report = ['Parser error: ' + file[1]]
-                
-            # Find an old Job or create a new one
-            existing = obj.validationjob_set.filter(name=file[0])
-            if len(existing) > 0:
-                new_job = existing[0]
-                new_job.last_result = result
-            else:    
-                new_job = obj.validationjob_set.create(name=file[0], ruleset=obj.ruleset, url=file[0], last_result=result)
-            new_job.save()
-            
-            # Create a new report
-            new_report = new_job.validationreport_set.create(run_date=datetime.datetime.now())
-            new_report.save()
-            
-            # Create report items
-            for item in report:
-                new_item = new_report.validationreportitem_set.create(item=item)
-                new_item.save()
-            
-            if len(new_report.validationreportitem_set.all()) == 0:
-                new_item = new_report.validationreportitem_set.create(item='Passed Validation Without Errors')
-                new_item.save()
+    def save_related(self, request, form, formsets, change):
+        super(ValidationSetAdmin, self).save_related(request, form, formsets, change)
+        # Harvesting and validation happen in a background worker once the rule sets are saved too. See jobqueue.py
+        form.instance.enqueue()
            
+class LinkCheckResultAdmin(admin.ModelAdmin):
+    list_display = ['url', 'passed', 'status', 'message', 'checked_at']
+    list_filter = ['passed']
+    search_fields = ['url']
+    
 admin.site.register(RuleSet, RuleSetAdmin)
 admin.site.register(ValidValuesSet, ValidValueSetAdmin)
 admin.site.register(Rule, RuleAdmin)
 admin.site.register(ValidationJob, ValidationJobAdmin)
 admin.site.register(ValidationReport, ValidationReportAdmin)
-admin.site.register(ValidationSet, ValidationSetAdmin)
\ No newline at end of file
+admin.site.register(ValidationSet, ValidationSetAdmin)
+admin.site.register(LinkCheckResult, LinkCheckResultAdmin)
@@ -0,0 +1,149 @@
+'''
+Validating many records against one rule set.
+
+RuleSet.xml_validate_many hands records to a pool of workers and yields each
+result as soon as it is ready. With the thread backend every worker shares the
+process's compiled rule set and HTTP client. XPath evaluation holds the GIL, so
+for large batches of local files or bytes the process backend spreads parsing and
+evaluation over every core instead: the rule graph is loaded once here, sent to
+each worker process when it starts and compiled there. Workers only use the
+database to remember link checks (see linkcheck), and each opens its own
+connection for that rather than sharing the parent's.
+'''
+
+import os, glob, tarfile, zipfile, multiprocessing, traceback
+from Queue import Queue
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.db import connection
+from engine import parse_record, ValidationException
+from compiled import CompiledRuleSet
+from httpclient import discard_default_client
+from linkcheck import discard_default_checker
+
+BACKENDS = ('threads', 'processes')
+
+def default_workers():
+    return getattr(settings, 'USGINVALID_WORKERS', 8)
+
+def validate_source(compiled, source, fail_fast=False):
+    '''
+    Given a CompiledRuleSet and a URL, file path or the bytes of a record
+    Returns (result, report). Records that cannot be fetched or parsed fail with a single report message.
+    '''
+    try:
+        return compiled.validate(parse_record(source), fail_fast)
+    except ValidationException, err:
+        return False, ['Validation Error: ' + err.msg]
+
+def _guarded(key, function, *args):
+    # Pool callbacks are not called for tasks that raise, so errors are returned and re-raised by the caller
+    try:
+        return key, function(*args), None
+    except Exception, err:
+        return key, None, traceback.format_exception_only(type(err), err)[-1].strip()
+
+_worker_ruleset = None
+
+def _start_worker(ruleset, graph):
+    global _worker_ruleset
+    # A connection inherited from the parent is dropped rather than closed, which would close it for the
+    # parent as well. The worker opens its own if a link check needs the database.
+    connection.connection = None
+    discard_default_client()
+    discard_default_checker()
+    _worker_ruleset = CompiledRuleSet(ruleset, graph)
+
+def _validate_in_worker(key, source, fail_fast):
+    return _guarded(key, validate_source, _worker_ruleset, source, fail_fast)
+
+def _validate_in_thread(key, compiled, source, fail_fast):
+    return _guarded(key, validate_source, compiled, source, fail_fast)
+
+def validate_named(ruleset, sources, workers=None, backend='threads', fail_fast=False):
+    '''
+    Given a RuleSet and an iterable of (name, source) tuples, where each source is a URL, file path or byte string
+    Yields (name, result, report) for every source, in the order validation finishes. Sources are read from
+    the iterable only as workers free up. With backend='processes' the sources must be strings.
+    With fail_fast, each report holds only the first failure found. See engine.record_is_valid.
+    '''
+    if backend not in BACKENDS:
+        raise ValueError('Unknown validation backend: ' + str(backend))
+    if workers is None: workers = default_workers()
+    workers = max(1, workers)
+
+    compiled = ruleset.compiled_rules()
+    if backend == 'processes':
+        # Loading the rule set may have opened a connection; close it so the workers are not forked with it
+        connection.close()
+        pool = multiprocessing.Pool(workers, _start_worker, (ruleset, compiled.graph))
+        task = lambda key, source: pool.apply_async(_validate_in_worker, (key, source, fail_fast), callback=finished.put)
+    else:
+        pool = ThreadPool(workers)
+        task = lambda key, source: pool.apply_async(_validate_in_thread, (key, compiled, source, fail_fast), callback=finished.put)
+
+    finished = Queue()
+    pending = dict()
+
+    def collect():
+        key, outcome, error = finished.get()
+        name = pending.pop(key)
+        if error is not None:
+            raise RuntimeError('Could not validate ' + repr(name)[:100] + ': ' + error)
+        return (name,) + tuple(outcome)
+
+    try:
+        for key, (name, source) in enumerate(sources):
+            pending[key] = name
+            task(key, source)
+            if len(pending) >= workers * 2:
+                yield collect()
+        while len(pending) > 0:
+            yield collect()
+    finally:
+        pool.terminate()
+
+def validate_many(ruleset, sources, workers=None, backend='threads', fail_fast=False):
+    '''
+    Given a RuleSet and an iterable of URLs, file paths or byte strings
+    Yields (source, result, report) for every source, in the order validation finishes
+    '''
+    return validate_named(ruleset, ((source, source) for source in sources), workers, backend, fail_fast)
+
+def is_record_name(name):
+    return name.lower().endswith('.xml')
+
+def local_sources(path):
+    '''
+    Given a directory, a glob pattern, or a tar or zip archive
+    Yields (name, source) tuples for every XML file in it, searching directories recursively. Files on disk are
+    given by path so they are read by whoever validates them; archive members are read here, one at a time.
+    '''
+    if os.path.isdir(path):
+        for folder, folders, files in os.walk(path):
+            folders.sort()
+            for name in sorted(files):
+                if is_record_name(name):
+                    yield os.path.join(folder, name), os.path.join(folder, name)
+    elif os.path.isfile(path) and tarfile.is_tarfile(path):
+        archive = tarfile.open(path, 'r:*')
+        try:
+            for member in archive:
+                if member.isfile() and is_record_name(member.name):
+                    yield path + '/' + member.name, archive.extractfile(member).read()
+                # Without this the archive keeps every member it has seen
+                archive.members = []
+        finally:
+            archive.close()
+    elif os.path.isfile(path) and zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        try:
+            for member in archive.infolist():
+                if not member.filename.endswith('/') and is_record_name(member.filename):
+                    yield path + '/' + member.filename, archive.read(member)
+        finally:
+            archive.close()
+    else:
+        for name in sorted(glob.glob(path)):
+            if os.path.isfile(name):
+                yield name, name
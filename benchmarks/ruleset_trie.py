@@ -0,0 +1,143 @@
+'''
+Compare rule evaluation with and without shared XPath prefixes (engine.PathTrie)
+using the USGIN minimum rule set from fixtures/initial_data.json.
+
+    python benchmarks/ruleset_trie.py [records] [extra citations per record] [repeats]
+
+Timings on a shared machine are noisy, so both modes are run repeats times,
+alternating, and the best time of each is reported.
+'''
+
+import os, sys, json, time
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from engine import RuleCompiler, Record, record_is_valid
+
+class FixtureNode(object):
+    '''
+    Stands in for graph.RuleNode without a database
+    '''
+    def __init__(self, pk, fields):
+        self.pk = pk
+        self.name = fields['name']
+        self.description = fields['description']
+        self.type = fields['type']
+        self.regex = fields['regex']
+        self.context = fields['context']
+        self.condition_rule_id = fields['condition_rule']
+        self.requirement_rule_id = fields['requirement_rule']
+        self.values_pk = fields['values']
+        self.xpaths = list()
+        self.values = list()
+
+def fixture_ruleset(ruleset_pk=1):
+    objects = json.load(open(os.path.join(ROOT, 'fixtures', 'initial_data.json')))
+    nodes = dict()
+    for obj in objects:
+        if obj['model'] == 'usginvalid.rule':
+            nodes[obj['pk']] = FixtureNode(obj['pk'], obj['fields'])
+    values = dict()
+    for obj in sorted(objects, key=lambda obj: obj['pk']):
+        if obj['model'] == 'usginvalid.xpath':
+            nodes[obj['fields']['rule']].xpaths.append(obj['fields']['xpath'])
+        if obj['model'] == 'usginvalid.validvalue':
+            values.setdefault(obj['fields']['set'], list()).append(obj['fields']['value'])
+    for node in nodes.values():
+        node.condition = nodes.get(node.condition_rule_id)
+        node.requirement = nodes.get(node.requirement_rule_id)
+        node.values = values.get(node.values_pk, list())
+    return [nodes[obj['fields']['rule']] for obj in objects 
+            if obj['model'] == 'usginvalid.ruletorulesetlink' and obj['fields']['ruleset'] == ruleset_pk]
+
+CITATION = '''
+      <gmd:citation><gmd:CI_Citation>
+        <gmd:title><gco:CharacterString>Geologic map %(index)d</gco:CharacterString></gmd:title>
+        <gmd:date><gmd:CI_Date>
+          <gmd:date><gco:DateTime>2010-06-01T00:00:00</gco:DateTime></gmd:date>
+          <gmd:dateType><gmd:CI_DateTypeCode codeList="http://standards.iso.org/ittf/PubliclyAvailableStandards/ISO_19139_Schemas/resources/Codelist/gmxCodelists.xml#CI_DateTypeCode" codeListValue="publication">publication</gmd:CI_DateTypeCode></gmd:dateType>
+        </gmd:CI_Date></gmd:date>
+        <gmd:citedResponsibleParty><gmd:CI_ResponsibleParty>
+          <gmd:individualName><gco:CharacterString>A. Geologist</gco:CharacterString></gmd:individualName>
+          <gmd:contactInfo><gmd:CI_Contact><gmd:phone><gmd:CI_Telephone><gmd:voice><gco:CharacterString>555-0100</gco:CharacterString></gmd:voice></gmd:CI_Telephone></gmd:phone></gmd:CI_Contact></gmd:contactInfo>
+          <gmd:role><gmd:CI_RoleCode codeList="http://standards.iso.org/ittf/PubliclyAvailableStandards/ISO_19139_Schemas/resources/Codelist/gmxCodelists.xml#CI_RoleCode" codeListValue="originator">originator</gmd:CI_RoleCode></gmd:role>
+        </gmd:CI_ResponsibleParty></gmd:citedResponsibleParty>
+      </gmd:CI_Citation></gmd:citation>'''
+
+KEYWORDS = '''
+      <gmd:descriptiveKeywords><gmd:MD_Keywords>%s</gmd:MD_Keywords></gmd:descriptiveKeywords>'''
+
+RECORD = '''<?xml version="1.0" encoding="UTF-8"?>
+<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd" xmlns:gco="http://www.isotc211.org/2005/gco">
+  <gmd:fileIdentifier><gco:CharacterString>record-%(index)d</gco:CharacterString></gmd:fileIdentifier>
+  <gmd:language><gco:CharacterString>eng</gco:CharacterString></gmd:language>
+  <gmd:characterSet><gmd:MD_CharacterSetCode codeList="http://standards.iso.org/ittf/PubliclyAvailableStandards/ISO_19139_Schemas/resources/Codelist/gmxCodelists.xml#MD_CharacterSetCode" codeListValue="utf8">utf8</gmd:MD_CharacterSetCode></gmd:characterSet>
+  <gmd:hierarchyLevel><gmd:MD_ScopeCode codeList="http://standards.iso.org/ittf/PubliclyAvailableStandards/ISO_19139_Schemas/resources/Codelist/gmxCodelists.xml#MD_ScopeCode" codeListValue="dataset">dataset</gmd:MD_ScopeCode></gmd:hierarchyLevel>
+  <gmd:hierarchyLevelName><gco:CharacterString>Dataset</gco:CharacterString></gmd:hierarchyLevelName>
+  <gmd:contact><gmd:CI_ResponsibleParty>
+    <gmd:organisationName><gco:CharacterString>Arizona Geological Survey</gco:CharacterString></gmd:organisationName>
+    <gmd:contactInfo><gmd:CI_Contact><gmd:address><gmd:CI_Address><gmd:electronicMailAddress><gco:CharacterString>metadata@azgs.az.gov</gco:CharacterString></gmd:electronicMailAddress></gmd:CI_Address></gmd:address></gmd:CI_Contact></gmd:contactInfo>
+    <gmd:role><gmd:CI_RoleCode codeList="http://standards.iso.org/ittf/PubliclyAvailableStandards/ISO_19139_Schemas/resources/Codelist/gmxCodelists.xml#CI_RoleCode" codeListValue="pointOfContact">pointOfContact</gmd:CI_RoleCode></gmd:role>
+  </gmd:CI_ResponsibleParty></gmd:contact>
+  <gmd:dateStamp><gco:DateTime>2011-03-12T10:00:00</gco:DateTime></gmd:dateStamp>
+  <gmd:metadataStandardName><gco:CharacterString>ISO-NAP-USGIN</gco:CharacterString></gmd:metadataStandardName>
+  <gmd:metadataStandardVersion><gco:CharacterString>1.1.4</gco:CharacterString></gmd:metadataStandardVersion>
+  <gmd:identificationInfo>
+    <gmd:MD_DataIdentification>%(citations)s
+      <gmd:abstract><gco:CharacterString>A synthetic record.</gco:CharacterString></gmd:abstract>
+      <gmd:status><gmd:MD_ProgressCode codeList="http://standards.iso.org/ittf/PubliclyAvailableStandards/ISO_19139_Schemas/resources/Codelist/gmxCodelists.xml#MD_ProgressCode" codeListValue="completed">completed</gmd:MD_ProgressCode></gmd:status>%(keywords)s
+      <gmd:language><gco:CharacterString>eng</gco:CharacterString></gmd:language>
+    </gmd:MD_DataIdentification>
+  </gmd:identificationInfo>
+  <gmd:distributionInfo><gmd:MD_Distribution>
+    <gmd:distributionFormat/>
+    <gmd:distributor><gmd:MD_Distributor><gmd:distributorContact><gmd:CI_ResponsibleParty>
+      <gmd:organisationName><gco:CharacterString>Arizona Geological Survey</gco:CharacterString></gmd:organisationName>
+      <gmd:role><gmd:CI_RoleCode codeList="http://standards.iso.org/ittf/PubliclyAvailableStandards/ISO_19139_Schemas/resources/Codelist/gmxCodelists.xml#CI_RoleCode" codeListValue="distributor">distributor</gmd:CI_RoleCode></gmd:role>
+    </gmd:CI_ResponsibleParty></gmd:distributorContact></gmd:MD_Distributor></gmd:distributor>
+    <gmd:transferOptions/>
+  </gmd:MD_Distribution></gmd:distributionInfo>
+</gmd:MD_Metadata>'''
+
+def synthetic_record(index, citations, keywords):
+    keyword = '<gmd:keyword><gco:CharacterString>keyword</gco:CharacterString></gmd:keyword>'
+    return RECORD % {'index': index, 
+                     'citations': ''.join([CITATION % {'index': n} for n in range(citations)]),
+                     'keywords': KEYWORDS % (keyword * keywords)}
+
+def run(rules, trees):
+    # Parsing is the same either way, so only rule evaluation is timed
+    start = time.time()
+    results = list()
+    for tree in trees:
+        results.append(record_is_valid(Record(tree), rules))
+    return time.time() - start, results
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    citations = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 7
+    nodes = fixture_ruleset()
+    records = [synthetic_record(index, citations, 500) for index in range(count)]
+    size = len(records[0]) / 1024
+    records = [Record.from_bytes(content).tree for content in records]
+    
+    # gmd:URL elements would send ValidUrlRule to the network; the synthetic records have none
+    direct_compiler, shared_compiler = RuleCompiler(shared_paths=False), RuleCompiler()
+    direct_rules = [direct_compiler.rule(node) for node in nodes]
+    shared_rules = [shared_compiler.rule(node) for node in nodes]
+    
+    run(direct_rules, records[:10])
+    run(shared_rules, records[:10])
+    direct, shared = list(), list()
+    for repeat in range(repeats):
+        elapsed, direct_results = run(direct_rules, records)
+        direct.append(elapsed)
+        elapsed, shared_results = run(shared_rules, records)
+        shared.append(elapsed)
+        assert direct_results == shared_results
+    direct, shared = min(direct), min(shared)
+    
+    print '%d rules, %d records of %d KB, %d citations each, %d failing rules per record' % (len(nodes), count, size, citations, len(direct_results[0][1]))
+    print 'direct XPaths: %.3f s (%.2f ms/record)' % (direct, direct * 1000 / count)
+    print 'shared prefix: %.3f s (%.2f ms/record)' % (shared, shared * 1000 / count)
+    print 'speedup: %.2fx' % (direct / shared)
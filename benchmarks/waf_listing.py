@@ -0,0 +1,42 @@
+'''
+Compare the lxml and BeautifulSoup WAF link extractors in harvest.py on large
+synthetic Apache autoindex pages.
+
+    python benchmarks/waf_listing.py [entries ...]
+'''
+
+import os, sys, time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from harvest import links_from_waf, links_from_waf_soup
+
+ROW = '<tr><td valign="top"><img src="/icons/text.gif" alt="[TXT]"></td><td><a href="%(name)s">%(name)s</a></td><td align="right">12-Mar-2011 10:%(minute)02d  </td><td align="right"> 14K</td><td>&nbsp;</td></tr>\n'
+
+def autoindex(entries):
+    rows = list()
+    for index in range(entries):
+        if index % 10 == 0:
+            name = 'folder-%d/' % index
+        else:
+            name = 'record-%06d.xml' % index
+        rows.append(ROW % {'name': name, 'minute': index % 60})
+    return ('<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">\n<html><head><title>Index of /metadata</title></head><body>'
+            '<h1>Index of /metadata</h1><table><tr><th><a href="?C=N;O=D">Name</a></th></tr>' + ''.join(rows) + '</table></body></html>')
+
+def best_of(function, page, repeat=3):
+    best = None
+    for attempt in range(repeat):
+        start = time.time()
+        links = list(function(page, 'http://example.com/metadata/'))
+        elapsed = time.time() - start
+        if best is None or elapsed < best: best = elapsed
+    return best, len(links)
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000]
+    print '%10s %10s %8s %10s %10s %8s' % ('entries', 'page KB', 'links', 'lxml s', 'soup s', 'speedup')
+    for entries in sizes:
+        page = autoindex(entries)
+        fast, fast_links = best_of(links_from_waf, page)
+        slow, slow_links = best_of(links_from_waf_soup, page, repeat=1)
+        assert fast_links == slow_links
+        print '%10d %10d %8d %10.3f %10.3f %7.1fx' % (entries, len(page) / 1024, fast_links, fast, slow, slow / fast)
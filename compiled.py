@@ -0,0 +1,132 @@
+'''
+Compiled rule sets.
+
+Building the rules for a RuleSet needs every Rule, its XPaths, its valid
+values and any conditional sub-rules. A CompiledRuleSet loads that graph once
+(see graph.py), compiles it into engine rules (see engine.py) and is kept in a process-level
+cache keyed by RuleSet primary key. Entries are tagged with the RuleSet version
+they were built from, and the whole cache is dropped by the signal handlers in
+models.py whenever rule data changes. Other processes see the bumped version
+instead, and reload the valid values of a rule set when they recompile it. Jobs and sets that target several rule
+sets use a CompiledRuleSetGroup, cached the same way.
+'''
+
+import threading
+from engine import RuleCompiler, record_is_valid
+
+_cache = dict()
+_cache_lock = threading.Lock()
+
+class CompiledRuleSet(object):
+    def __init__(self, ruleset, graph=None, compiler=None, reload_values=False):
+        # A graph loaded elsewhere can be passed in to compile without touching the database
+        if graph is None:
+            graph = ruleset.load_graph(reload_values)
+        self.pk = ruleset.pk
+        self.name = ruleset.name
+        self.version = ruleset.version
+        self.graph = graph
+        # Rule sets compiled with the same compiler share Rule objects and path prefixes
+        self.compiler = compiler or RuleCompiler()
+        self.rules = list()
+        for node in self.graph:
+            self.rules.append(self.compiler.rule(node))
+
+    def __len__(self):
+        return len(self.rules)
+    
+    def validate(self, record, fail_fast=False):
+        '''
+        Given a parsed engine.Record
+        Returns (result, report). See engine.record_is_valid for fail_fast.
+        '''
+        return record_is_valid(record, self.rules, fail_fast)
+
+def compiled_ruleset(ruleset):
+    '''
+    Given a RuleSet instance
+    Returns the cached CompiledRuleSet for it, building it if the cache is empty or stale
+    '''
+    with _cache_lock:
+        compiled = _cache.get(ruleset.pk)
+        if compiled is None or compiled.version != ruleset.version:
+            # The version may have been bumped by a change to valid values made in another process, which
+            # did not clear this process's value tables
+            compiled = CompiledRuleSet(ruleset, reload_values=True)
+            _cache[ruleset.pk] = compiled
+        return compiled
+
+def ruleset_signature(rulesets):
+    '''
+    Given a list of RuleSets
+    Returns a string that changes whenever the list or the rules in any of them change
+    '''
+    return ','.join(['%d:%d' % (ruleset.pk, ruleset.version) for ruleset in rulesets])
+
+class CompiledRuleSetGroup(object):
+    '''
+    Several rule sets compiled together. A rule belonging to more than one of them is a single Rule, so it is
+    evaluated once per record however many of the rule sets use it, and XPath prefixes are shared across them all.
+    '''
+    def __init__(self, rulesets):
+        self.signature = ruleset_signature(rulesets)
+        self.compiler = RuleCompiler()
+        self.members = [CompiledRuleSet(ruleset, compiler=self.compiler, reload_values=True) for ruleset in rulesets]
+
+    def validate(self, record, fail_fast=False):
+        '''
+        Given a parsed engine.Record
+        Returns a list of (result, report), one for each rule set in order
+        '''
+        return [member.validate(record, fail_fast) for member in self.members]
+
+_groups = dict()
+
+def compiled_group(rulesets):
+    '''
+    Given a list of RuleSet instances
+    Returns the cached CompiledRuleSetGroup for them, building it if the cache is empty or stale
+    '''
+    key = tuple(ruleset.pk for ruleset in rulesets)
+    with _cache_lock:
+        group = _groups.get(key)
+        if group is None or group.signature != ruleset_signature(rulesets):
+            group = CompiledRuleSetGroup(rulesets)
+            _groups[key] = group
+        return group
+
+def invalidate():
+    '''
+    Drop every compiled rule set held by this process
+    '''
+    with _cache_lock:
+        _cache.clear()
+        _groups.clear()
+
+_value_tables = dict()
+_value_tables_lock = threading.Lock()
+
+def value_tables(set_pks, reload=False):
+    '''
+    Given primary keys of ValidValuesSets
+    Returns a dictionary of frozensets of their values, keyed by pk. Sets not already cached, or all of
+    them with reload, are loaded together in one query, and every rule using a set shares the same frozenset.
+    '''
+    from models import ValidValue
+    
+    with _value_tables_lock:
+        missing = [pk for pk in set_pks if reload or pk not in _value_tables]
+        if len(missing) > 0:
+            loaded = dict((pk, list()) for pk in missing)
+            for set_pk, value in ValidValue.objects.filter(set__in=missing).values_list('set', 'value'):
+                loaded[set_pk].append(value)
+            for pk, values in loaded.items():
+                _value_tables[pk] = frozenset(values)
+        return dict((pk, _value_tables[pk]) for pk in set_pks)
+
+def invalidate_value_table(pk):
+    '''
+    Drop the cached values of one ValidValuesSet
+    '''
+    with _value_tables_lock:
+        _value_tables.pop(pk, None)
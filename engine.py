@@ -0,0 +1,423 @@
+'''
+Rule evaluation against parsed records.
+
+A record is fetched and parsed into a single lxml tree once, wrapped in a
+Record, and that one tree is handed to every rule, including the condition and
+requirement of ConditionalRules. The same Record can be validated against any
+number of rule sets. Rules are built from the RuleNodes of a loaded rule graph
+(see graph.py) by a RuleCompiler, which compiles every XPath with the ISO
+namespaces bound, and every regular expression, ahead of time.
+'''
+
+import re, time
+from StringIO import StringIO
+from lxml import etree
+from httpclient import default_client
+from linkcheck import default_checker
+
+NAMESPACES = {'gmd': 'http://www.isotc211.org/2005/gmd',
+              'gco': 'http://www.isotc211.org/2005/gco',
+              'gmx': 'http://www.isotc211.org/2005/gmx',
+              'gts': 'http://www.isotc211.org/2005/gts',
+              'srv': 'http://www.isotc211.org/2005/srv',
+              'gml': 'http://www.opengis.net/gml',
+              'xlink': 'http://www.w3.org/1999/xlink',
+              'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+              'csw': 'http://www.opengis.net/cat/csw/2.0.2'}
+
+class ValidationException(Exception):
+    '''
+    Raised when a record cannot be fetched or parsed
+    '''
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
+        self.msg = msg
+
+class Record(object):
+    '''
+    A parsed metadata record, shared by every rule that validates it
+    '''
+    def __init__(self, tree, source=None):
+        self.tree = tree
+        self.source = source
+        # Node sets of shared path prefixes, filled in as rules ask for them. See PathTrie.
+        self.nodesets = dict()
+        # The outcome of every rule evaluated so far, so that no rule runs twice. See Rule.validate.
+        self.outcomes = dict()
+
+    @classmethod
+    def from_bytes(cls, content, source=None):
+        try:
+            tree = etree.parse(StringIO(content))
+        except etree.XMLSyntaxError, err:
+            raise ValidationException('Could not parse ' + (source or 'record') + ': ' + str(err))
+        return cls(tree, source)
+
+    @classmethod
+    def from_url(cls, url):
+        try:
+            content = default_client().get(url).raise_for_status().content
+        except IOError, err:
+            raise ValidationException(str(err))
+        return cls.from_bytes(content, url)
+
+    @classmethod
+    def from_path(cls, path):
+        try:
+            with open(path, 'rb') as handle:
+                content = handle.read()
+        except IOError, err:
+            raise ValidationException('Could not read ' + path + ': ' + str(err))
+        return cls.from_bytes(content, path)
+
+def parse_record(source):
+    '''
+    Given a Record, an lxml tree or element, a URL, a file path, a file-like object or the bytes of a record
+    Returns a Record
+    '''
+    if isinstance(source, Record):
+        return source
+    if isinstance(source, etree._ElementTree):
+        return Record(source)
+    if isinstance(source, etree._Element):
+        return Record(source.getroottree())
+    if hasattr(source, 'read'):
+        return Record.from_bytes(source.read())
+    if source.lstrip('\xef\xbb\xbf \t\r\n').startswith('<'):
+        return Record.from_bytes(source)
+    if source.startswith('http://') or source.startswith('https://'):
+        return Record.from_url(source)
+    return Record.from_path(source)
+
+def node_values(nodes):
+    '''
+    Returns the text of each element, or the value of each attribute or string, in an XPath result
+    '''
+    values = list()
+    for node in nodes:
+        if isinstance(node, basestring):
+            values.append(node.strip())
+        elif node.text is not None:
+            values.append(node.text.strip())
+        else:
+            values.append('')
+    return values
+
+SIMPLE_STEP = re.compile(r'^@?[\w.*-]+(:[\w.*-]+)?$')
+
+def split_steps(expression):
+    '''
+    Given an XPath expression
+    Returns its location steps as a list of (separator, step) tuples if it is an absolute path made only of
+    plain name tests, otherwise None
+    '''
+    if not expression.startswith('/'):
+        return None
+    steps = re.findall(r'(//?)([^/]+)', expression)
+    if ''.join([separator + step for separator, step in steps]) != expression:
+        return None
+    if not all(SIMPLE_STEP.match(step) for separator, step in steps):
+        return None
+    return steps
+
+class DirectPath(object):
+    '''
+    An XPath that cannot share work with others and is evaluated against the whole document
+    '''
+    def __init__(self, xpath):
+        self.xpath = xpath
+
+    def select(self, record):
+        return self.xpath(record.tree)
+
+class PathTrie(object):
+    '''
+    One location step in a prefix tree of the absolute XPaths used by a rule set. Node sets are computed once
+    per record and shared by every path that starts with the same steps. A step is evaluated relative to the
+    nearest ancestor with only a few nodes, so shared prefixes are not walked again from the root, and wide
+    node sets are never looped over in Python.
+    '''
+    # Ancestors with more nodes than this are skipped over when choosing where to evaluate from
+    MAX_CONTEXTS = 4
+    
+    def __init__(self, parent=None, separator='', step=''):
+        self.parent = parent
+        self.children = dict()
+        self.steps = list()
+        self.relative = dict()
+        # Whether this step's node set was too wide to evaluate from in the last record. Records of one
+        # catalog are shaped alike, so descendants skip it without computing a node set they would not use.
+        self.wide = False
+        if parent is not None:
+            self.steps = parent.steps + [(separator, step)]
+            self.absolute = etree.XPath(''.join([sep + name for sep, name in self.steps]), namespaces=NAMESPACES)
+
+    def child(self, separator, step):
+        if (separator, step) not in self.children:
+            self.children[(separator, step)] = PathTrie(self, separator, step)
+        return self.children[(separator, step)]
+
+    def relative_to(self, ancestor):
+        # Compiled on first use; a node only ever needs paths from a few of its ancestors
+        if ancestor not in self.relative:
+            steps = self.steps[len(ancestor.steps):]
+            self.relative[ancestor] = etree.XPath('.' + ''.join([sep + name for sep, name in steps]), namespaces=NAMESPACES)
+        return self.relative[ancestor]
+
+    def select(self, record):
+        if self.parent is None:
+            return [record.tree]
+        if self in record.nodesets:
+            return record.nodesets[self]
+
+        anchor = self.parent
+        while anchor.parent is not None and (anchor.wide or len(anchor.select(record)) > self.MAX_CONTEXTS):
+            anchor = anchor.parent
+
+        if anchor.parent is None:
+            result = self.absolute(record.tree)
+        else:
+            contexts = [node for node in anchor.select(record) if not isinstance(node, basestring)]
+            path = self.relative_to(anchor)
+            if len(contexts) == 1:
+                result = path(contexts[0])
+            else:
+                result = list()
+                seen = set()
+                for context in contexts:
+                    for node in path(context):
+                        if isinstance(node, basestring):
+                            result.append(node)
+                        elif node not in seen:
+                            seen.add(node)
+                            result.append(node)
+        self.wide = len(result) > self.MAX_CONTEXTS
+        record.nodesets[self] = result
+        return result
+
+# Expected milliseconds to evaluate a rule of each type against a typical record, used until real timings
+# are in. Network checks are by far the slowest, so they always come last when rules are ordered by cost.
+RULE_COSTS = {'ExistsRule': 0.01,
+              'AnyOfRule': 0.02,
+              'OneOfRule': 0.02,
+              'ValueInListRule': 0.02,
+              'ContentMatchesExpressionRule': 0.03,
+              'ConditionalRule': 0.03,
+              'ValidUrlRule': 100.0}
+
+# How many timings the prior cost counts for
+PRIOR_WEIGHT = 5
+
+class Rule(object):
+    def __init__(self, node, compiler):
+        self.pk = node.pk
+        self.name = node.name
+        self.description = node.description
+        self.type = node.type
+        # Running total of measured evaluation time in milliseconds. See cost().
+        self.elapsed = 0.0
+        self.evaluations = 0
+
+    def __unicode__(self):
+        return self.name
+
+    def message(self):
+        return self.name + ': ' + self.description
+
+    def validate(self, record):
+        '''
+        Given a Record
+        Returns whether it passes this rule. A rule that is both in a rule set and the condition or requirement
+        of a ConditionalRule, or shared by several of them, is only evaluated once per record.
+        '''
+        if self not in record.outcomes:
+            started = time.time()
+            record.outcomes[self] = self.evaluate(record)
+            self.elapsed += (time.time() - started) * 1000
+            self.evaluations += 1
+        return record.outcomes[self]
+
+    def cost(self):
+        '''
+        Returns the mean measured milliseconds per evaluation, weighted towards the prior for the rule's type
+        until enough evaluations have been timed
+        '''
+        prior = RULE_COSTS.get(self.type, 1.0)
+        return (prior * PRIOR_WEIGHT + self.elapsed) / (PRIOR_WEIGHT + self.evaluations)
+
+    def evaluate(self, record):
+        raise NotImplementedError
+
+class ExistsRule(Rule):
+    def __init__(self, node, compiler):
+        Rule.__init__(self, node, compiler)
+        self.path = compiler.select(node.xpaths[0])
+
+    def evaluate(self, record):
+        return len(self.path.select(record)) > 0
+
+class ValueInListRule(Rule):
+    def __init__(self, node, compiler):
+        Rule.__init__(self, node, compiler)
+        self.path = compiler.select(node.xpaths[0])
+        self.values = node.values
+
+    def evaluate(self, record):
+        values = node_values(self.path.select(record))
+        return len(values) > 0 and all(value in self.values for value in values)
+
+class AnyOfRule(Rule):
+    def __init__(self, node, compiler):
+        Rule.__init__(self, node, compiler)
+        self.context = None
+        if (node.context or '') in ['', '/']:
+            self.paths = [compiler.select(path) for path in node.xpaths]
+        else:
+            self.context = compiler.select(node.context)
+            self.paths = [compiler.xpath('.' + path) for path in node.xpaths]
+
+    def evaluate(self, record):
+        if self.context is None:
+            return any(len(path.select(record)) > 0 for path in self.paths)
+
+        # Every context element must have at least one of the paths beneath it
+        contexts = self.context.select(record)
+        if len(contexts) == 0:
+            return False
+        for context in contexts:
+            if not any(len(path(context)) > 0 for path in self.paths):
+                return False
+        return True
+
+class OneOfRule(Rule):
+    def __init__(self, node, compiler):
+        Rule.__init__(self, node, compiler)
+        self.paths = [compiler.select(path) for path in node.xpaths]
+
+    def evaluate(self, record):
+        return len([path for path in self.paths if len(path.select(record)) > 0]) == 1
+
+class ContentMatchesExpressionRule(Rule):
+    def __init__(self, node, compiler):
+        Rule.__init__(self, node, compiler)
+        self.path = compiler.select(node.xpaths[0])
+        self.regex = compiler.regex(node.regex)
+
+    def evaluate(self, record):
+        values = node_values(self.path.select(record))
+        return len(values) > 0 and all(self.regex.search(value) is not None for value in values)
+
+class ConditionalRule(Rule):
+    def __init__(self, node, compiler):
+        Rule.__init__(self, node, compiler)
+        self.condition = compiler.rule(node.condition)
+        self.requirement = compiler.rule(node.requirement)
+
+    def evaluate(self, record):
+        return not self.condition.validate(record) or self.requirement.validate(record)
+
+class ValidUrlRule(Rule):
+    def __init__(self, node, compiler):
+        Rule.__init__(self, node, compiler)
+        self.path = compiler.select(node.xpaths[0])
+
+    def evaluate(self, record):
+        # Every URL in the record is checked at once, and links checked recently are not fetched again
+        urls = node_values(self.path.select(record))
+        if len(urls) == 0:
+            return True
+        return all(default_checker().check_all(urls).values())
+
+RULE_CLASSES = {'ExistsRule': ExistsRule,
+                'ValueInListRule': ValueInListRule,
+                'AnyOfRule': AnyOfRule,
+                'OneOfRule': OneOfRule,
+                'ContentMatchesExpressionRule': ContentMatchesExpressionRule,
+                'ConditionalRule': ConditionalRule,
+                'ValidUrlRule': ValidUrlRule}
+
+class RuleCompiler(object):
+    '''
+    Builds Rules from the RuleNodes of one graph. Each rule, XPath expression and regular expression
+    is compiled once, however many rules share it, and the compiled objects live as long as the compiler.
+    With shared_paths, absolute XPaths are broken into steps and merged into a PathTrie.
+    '''
+    def __init__(self, shared_paths=True):
+        self.rules = dict()
+        self.xpaths = dict()
+        self.regexes = dict()
+        self.selectors = dict()
+        # RuleNodes whose rules are being built, innermost last
+        self.compiling = list()
+        self.shared_paths = shared_paths
+        self.trie = PathTrie()
+
+    def rule(self, node):
+        '''
+        Given a RuleNode
+        Returns its Rule. Rules are shared by primary key, so conditional rules form a DAG over the rule set.
+        Raises ValidationException if conditional rules depend on each other in a cycle.
+        '''
+        if node.pk not in self.rules:
+            if node.pk in [pending.pk for pending in self.compiling]:
+                cycle = self.compiling[[pending.pk for pending in self.compiling].index(node.pk):] + [node]
+                raise ValidationException('Conditional rules depend on each other in a cycle: ' + 
+                                          ' -> '.join([pending.name for pending in cycle]))
+            self.compiling.append(node)
+            try:
+                self.rules[node.pk] = RULE_CLASSES[node.type](node, self)
+            finally:
+                self.compiling.pop()
+        return self.rules[node.pk]
+
+    def xpath(self, expression):
+        if expression not in self.xpaths:
+            try:
+                self.xpaths[expression] = etree.XPath(expression, namespaces=NAMESPACES)
+            except etree.XPathSyntaxError, err:
+                raise ValidationException('Invalid XPath ' + expression + ': ' + str(err))
+        return self.xpaths[expression]
+
+    def select(self, expression):
+        '''
+        Given an XPath expression evaluated against whole documents
+        Returns an object whose select(record) gives the matching nodes. Absolute paths of plain steps go into
+        the rule set's PathTrie so common prefixes are evaluated once per record.
+        '''
+        if expression not in self.selectors:
+            steps = split_steps(expression)
+            if not self.shared_paths or steps is None:
+                self.selectors[expression] = DirectPath(self.xpath(expression))
+            else:
+                node = self.trie
+                for separator, step in steps:
+                    node = node.child(separator, step)
+                self.selectors[expression] = node
+        return self.selectors[expression]
+
+    def regex(self, expression):
+        if expression not in self.regexes:
+            try:
+                self.regexes[expression] = re.compile(expression)
+            except re.error, err:
+                raise ValidationException('Invalid regular expression ' + expression + ': ' + str(err))
+        return self.regexes[expression]
+
+def record_is_valid(record, rules, fail_fast=False):
+    '''
+    Given a Record and a list of Rules
+    Returns (result, report): whether every rule passed, and a message for each rule that did not.
+    With fail_fast, rules run cheapest first and evaluation stops at the first failure, which is the only
+    message in the report.
+    '''
+    if fail_fast:
+        for rule in sorted(rules, key=lambda rule: rule.cost()):
+            if not rule.validate(record):
+                return False, [rule.message()]
+        return True, []
+
+    report = list()
+    for rule in rules:
+        if not rule.validate(record):
+            report.append(rule.message())
+    return len(report) == 0, report
@@ -0,0 +1,65 @@
+'''
+Fetching metadata records with HTTP validators.
+
+A FetchedRecord remembers the ETag and Last-Modified headers and a hash of the
+content, which are stored on the ValidationJob so that the next run can send a
+conditional GET and skip records that have not changed. Records can also be
+read through the on-disk cache in recordcache.py.
+'''
+
+import hashlib
+from httpclient import default_client
+
+class FetchedRecord(object):
+    def __init__(self, url, content=None, etag='', last_modified='', not_modified=False):
+        self.url = url
+        self.content = content
+        self.etag = etag or ''
+        self.last_modified = last_modified or ''
+        self.not_modified = not_modified
+        self.content_hash = ''
+        if content is not None:
+            self.content_hash = content_hash(content)
+
+def content_hash(content):
+    return hashlib.sha1(content).hexdigest()
+
+def fetch_record(url, etag='', last_modified='', cache=None, cache_only=False):
+    '''
+    Given a URL and optionally the ETag and Last-Modified values from an earlier fetch
+    Returns a FetchedRecord. If the server answers 304 Not Modified, its content is None and not_modified is True.
+    
+    Given a recordcache.RecordCache, the validators of the cached copy are sent instead when there is one, a 304
+    answer is served from the cache, and new content is stored in it. With cache_only, no request is made at all
+    and an IOError is raised for records that are not in the cache.
+    '''
+    entry = None
+    if cache is not None:
+        entry = cache.get(url)
+        content = entry and cache.content(entry)
+        if content is None:
+            entry = None
+        elif cache_only:
+            return FetchedRecord(url, content, entry.etag, entry.last_modified)
+        else:
+            etag, last_modified = entry.etag, entry.last_modified
+    if cache_only:
+        raise IOError('Not in the record cache: ' + url)
+    
+    headers = dict()
+    if etag != '':
+        headers['If-None-Match'] = etag
+    if last_modified != '':
+        headers['If-Modified-Since'] = last_modified
+
+    response = default_client().get(url, headers)
+    if response.status == 304:
+        if entry is not None:
+            return FetchedRecord(url, content, etag, last_modified)
+        return FetchedRecord(url, etag=etag, last_modified=last_modified, not_modified=True)
+    response.raise_for_status()
+    
+    record = FetchedRecord(url, response.content, response.headers.get('etag'), response.headers.get('last-modified'))
+    if cache is not None:
+        cache.put(url, record.content, record.etag, record.last_modified)
+    return record
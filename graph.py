@@ -0,0 +1,103 @@
+'''
+In-memory rule graphs.
+
+Walking rules through the ORM costs a query per XPath set, per value set and
+per conditional sub-rule. load_graph fetches a group of rules together with
+everything they depend on in a fixed number of queries and returns plain
+RuleNode objects that the compiler and the views can use without touching the
+database again.
+'''
+
+from compiled import value_tables
+
+class RuleNode(object):
+    '''
+    A database-free copy of a Rule with its XPaths, valid values and sub-rules resolved
+    '''
+    def __init__(self, rule):
+        self.pk = rule.pk
+        self.name = rule.name
+        self.description = rule.description
+        self.type = rule.type
+        self.regex = rule.regex
+        self.context = rule.context
+        self.condition_rule_id = rule.condition_rule_id
+        self.requirement_rule_id = rule.requirement_rule_id
+        self.values_pk = rule.values_id
+        self.values_name = None
+        if rule.values_id is not None:
+            self.values_name = rule.values.name
+
+        # Filled in by load_graph once all related rows are fetched
+        self.xpaths = list()
+        self.values = frozenset()
+        self.condition = None
+        self.requirement = None
+
+    def __unicode__(self):
+        return self.name
+
+class RuleGraph(object):
+    '''
+    The top-level rules of a group, in order, plus every node reachable from them keyed by pk
+    '''
+    def __init__(self, rules, nodes):
+        self.rules = rules
+        self.nodes = nodes
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __len__(self):
+        return len(self.rules)
+
+def load_graph(rules, reload_values=False):
+    '''
+    Given an iterable of Rule instances (ideally a queryset using select_related('values'))
+    Returns a RuleGraph. Costs one query per level of conditional nesting, plus one each for
+    XPaths and any valid values not already cached (or all of them, with reload_values), regardless
+    of how many rules there are.
+    '''
+    from models import Rule, XPath
+
+    nodes = dict()
+    top = list()
+    for rule in rules:
+        if rule.pk not in nodes:
+            nodes[rule.pk] = RuleNode(rule)
+        top.append(nodes[rule.pk])
+
+    # Pull in conditional sub-rules until nothing is missing
+    missing = set()
+    for node in nodes.values():
+        missing.update(pk for pk in [node.condition_rule_id, node.requirement_rule_id] if pk is not None)
+    missing.difference_update(nodes)
+    while len(missing) > 0:
+        fetched = list(Rule.objects.filter(pk__in=missing).select_related('values'))
+        missing = set()
+        for rule in fetched:
+            nodes[rule.pk] = RuleNode(rule)
+        for rule in fetched:
+            missing.update(pk for pk in [rule.condition_rule_id, rule.requirement_rule_id] if pk is not None)
+        missing.difference_update(nodes)
+
+    for node in nodes.values():
+        if node.condition_rule_id is not None:
+            node.condition = nodes[node.condition_rule_id]
+        if node.requirement_rule_id is not None:
+            node.requirement = nodes[node.requirement_rule_id]
+
+    if len(nodes) > 0:
+        xpaths = XPath.objects.filter(rule__in=nodes.keys()).order_by('pk').values_list('rule', 'xpath')
+        for rule_pk, xpath in xpaths:
+            nodes[rule_pk].xpaths.append(xpath)
+
+        # Rules sharing a value set share one frozenset, cached across graphs
+        set_pks = set(node.values_pk for node in nodes.values() if node.values_pk is not None)
+        if len(set_pks) > 0:
+            tables = value_tables(set_pks, reload_values)
+            for node in nodes.values():
+                if node.values_pk is not None:
+                    node.values = tables[node.values_pk]
+
+    return RuleGraph(top, nodes)
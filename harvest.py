@@ -0,0 +1,314 @@
+import re
+from StringIO import StringIO
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from urllib import urlencode
+from BeautifulSoup import BeautifulSoup
+from urlparse import urljoin, urlparse, parse_qsl, ParseResult, urlunparse
+from lxml import etree
+from httpclient import default_client
+
+def string_is_getrecords(response_string):
+    return sniff_root(StringIO(response_string))[0] == CSW_GETRECORDS_RESPONSE
+
+def construct_recordbyid_request(recordId, parsed_csw_url):
+    query = 'request=GetRecordById&service=CSW&Id=' + recordId + '&elementSetName=full&outputSchema=http://www.isotc211.org/2005/gmd'
+    url_builder = ParseResult(scheme=parsed_csw_url.scheme, 
+                              netloc=parsed_csw_url.netloc, 
+                              path=parsed_csw_url.path, 
+                              params='', 
+                              query=query, 
+                              fragment='')
+    return urlunparse(url_builder)
+    
+def read_url(url):
+    return default_client().get(url).raise_for_status().content
+
+def open_url(url):
+    '''
+    Given a url
+    Returns a file-like object to read the response body from as it downloads
+    '''
+    return default_client().open(url).raise_for_status()
+
+class ReplayStream(object):
+    '''
+    A file-like object that returns the data already read from a stream before reading the rest of it
+    '''
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+        
+    def read(self, size=-1):
+        if self.prefix == '':
+            return self.stream.read(size)
+        if size < 0:
+            data, self.prefix = self.prefix + self.stream.read(), ''
+        else:
+            data, self.prefix = self.prefix[:size], self.prefix[size:]
+        return data
+
+def sniff_root(stream, chunk_size=8192):
+    '''
+    Given a file-like object
+    Returns a tuple: (tag of the document's root element or None if it is not XML, the data read so far).
+    Only as much of the stream is read as it takes to reach the root element's start tag.
+    '''
+    parser = etree.XMLPullParser(events=('start',))
+    read = []
+    while True:
+        chunk = stream.read(chunk_size)
+        read.append(chunk)
+        try:
+            if chunk == '':
+                parser.close()
+            else:
+                parser.feed(chunk)
+            for event, element in parser.read_events():
+                return (element.tag, ''.join(read))
+        except etree.XMLSyntaxError:
+            return (None, ''.join(read))
+        if chunk == '':
+            return (None, ''.join(read))
+
+CSW_NAMESPACES = {'csw': 'http://www.opengis.net/cat/csw/2.0.2',
+                  'dc': 'http://purl.org/dc/elements/1.1/'}
+CSW_GETRECORDS_RESPONSE = '{http://www.opengis.net/cat/csw/2.0.2}GetRecordsResponse'
+CSW_SEARCH_RESULTS = '{http://www.opengis.net/cat/csw/2.0.2}SearchResults'
+CSW_BRIEF_RECORD = '{http://www.opengis.net/cat/csw/2.0.2}BriefRecord'
+
+def file_from_brief_record(record, csw):
+    '''
+    Given a csw:BriefRecord element and the parsed CSW url
+    Returns a tuple: (url to get the individual record, error message)
+    '''
+    # Finding the FileID might get tricky
+    identifiers = record.xpath('dc:identifier', namespaces=CSW_NAMESPACES)
+    if len(identifiers) == 1:
+        return (construct_recordbyid_request(identifiers[0].text, csw), '')
+    
+    # Find the ESRI-style file ID
+    fileId = record.xpath('dc:identifier[@scheme="urn:x-esri:specification:ServiceType:ArcIMS:Metadata:FileID"]', namespaces=CSW_NAMESPACES)
+    if len(fileId) == 1: 
+        return (construct_recordbyid_request(fileId[0].text, csw), '')
+    
+    # Could look for other-style file IDs here
+    return ('', 'Could not find File Identifier in csw:BriefRecord.')
+
+class GetRecordsPage(object):
+    '''
+    Iterates over one csw:GetRecordsResponse, given as a file-like object, yielding a tuple for each
+    csw:BriefRecord as soon as it has been read. Only one record is held in memory at a time.
+    Once exhausted, next_record and returned hold the csw:SearchResults paging attributes.
+    '''
+    def __init__(self, stream, url):
+        self.stream = stream
+        self.csw = urlparse(url)
+        self.next_record = 0
+        self.returned = 0
+        
+    def __iter__(self):
+        for event, element in etree.iterparse(self.stream, events=('start', 'end')):
+            if event == 'start':
+                if element.tag == CSW_SEARCH_RESULTS:
+                    self.next_record = int(element.get('nextRecord', '0') or 0)
+                continue
+            
+            if element.tag == CSW_BRIEF_RECORD:
+                self.returned += 1
+                yield file_from_brief_record(element, self.csw)
+                
+                # Drop the record and anything parsed before it
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+def page_url(url, start_position):
+    '''
+    Given a GetRecords KVP url
+    Returns the same request asking for records from start_position on
+    '''
+    parsed = urlparse(url)
+    query = [pair for pair in parse_qsl(parsed.query, keep_blank_values=True) if pair[0].lower() != 'startposition']
+    query.append(('startPosition', str(start_position)))
+    return urlunparse(parsed._replace(query=urlencode(query)))
+
+def files_from_csw(url, first_page=None, open_url=open_url):
+    '''
+    Given the url of a csw:GetRecords request and optionally its response, as a string or a file-like object
+    Yields tuples: (url to get an individual record, error message), following csw:SearchResults/@nextRecord
+    through every page of results. Each page is parsed as it downloads.
+    '''
+    if first_page is None:
+        stream = open_url(url)
+    elif isinstance(first_page, basestring):
+        stream = StringIO(first_page)
+    else:
+        stream = first_page
+    
+    found = 0
+    seen = set()
+    while True:
+        page = GetRecordsPage(stream, url)
+        for file in page:
+            yield file
+        found += page.returned
+        
+        # nextRecord is 0 after the last page. Guard against catalogs that repeat a page forever.
+        if page.returned == 0 or page.next_record <= 0 or page.next_record in seen:
+            break
+        seen.add(page.next_record)
+        stream = open_url(page_url(url, page.next_record))
+        
+    if found == 0:
+        # There were no brief records. Maybe the request is bad, maybe there are just no records.
+        yield ('', 'No csw:BriefRecord elements found in csw:GetRecordsResponse.')
+
+def file_list_from_csw(getrecords_string, url):
+    '''
+    Given a string representing a single csw:GetRecords response
+    Returns a list of tuples: (url to get an individual record, error message)
+    '''
+    files = list(GetRecordsPage(StringIO(getrecords_string), url))
+    if len(files) == 0:
+        return [('', 'No csw:BriefRecord elements found in csw:GetRecordsResponse.')]
+    return files
+
+# Same test BeautifulSoup applied to href values
+XML_HREF = re.compile('.+\.xml')
+# Links to folders in an autoindex page, ignoring column sorting links
+FOLDER_HREF = re.compile('^[^?#]+/$')
+# A page's DOCTYPE declaration, with anything before it
+DOCTYPE = re.compile('^[^<]*(<\?[^>]*>\s*)?<!doctype[^>]*>', re.IGNORECASE)
+
+def links_from_waf(response_string, url, pattern=XML_HREF, chunk_size=65536):
+    '''
+    Given a string representing a web-accessible folder's HTML
+    Yields absolute urls of links whose href matches pattern as they are found, using lxml's pull parser
+    '''
+    parser = etree.HTMLPullParser(events=('start',), tag='a')
+    # libxml2's HTML push parser can crash if a chunk ends inside the DOCTYPE declaration, so the first
+    # chunk always runs past it
+    first = chunk_size
+    doctype = DOCTYPE.match(response_string)
+    if doctype is not None:
+        first = max(first, doctype.end())
+    offsets = [0] + range(first, len(response_string), chunk_size) + [len(response_string)]
+    for start, end in zip(offsets, offsets[1:]) + [(None, None)]:
+        if start is None:
+            parser.close()
+        else:
+            parser.feed(response_string[start:end])
+        for event, element in parser.read_events():
+            href = element.get('href')
+            if href is not None and pattern.search(href) is not None:
+                yield urljoin(url, href)
+
+def links_from_waf_soup(response_string, url, pattern=XML_HREF):
+    '''
+    Given a string representing a web-accessible folder's HTML
+    Returns absolute urls of links whose href matches pattern. Slow, but copes with anything.
+    '''
+    soup = BeautifulSoup(response_string)
+    tags = soup.findAll('a', href=pattern)
+    return [urljoin(url, tag['href']) for tag in tags]
+
+def waf_links(response_string, url, pattern=XML_HREF):
+    '''
+    Yields absolute urls of links whose href matches pattern.
+    Pages that lxml cannot parse are handed to BeautifulSoup instead.
+    '''
+    found = set()
+    try:
+        for link in links_from_waf(response_string, url, pattern):
+            found.add(link)
+            yield link
+    except (etree.LxmlError, ValueError):
+        for link in links_from_waf_soup(response_string, url, pattern):
+            if link not in found:
+                yield link
+
+def files_from_waf(response_string, url):
+    '''
+    Given a string representing a web-accessible folder's HTML
+    Yields tuples: (url to get an individual record, error message)
+    '''
+    for link in waf_links(response_string, url):
+        yield (link, '')
+
+def file_list_from_waf(response_string, url):
+    '''
+    Given a string representing a web-accessible folder's HTML
+    Returns a list of tuples: (url to get an individual record, error message)
+    '''
+    return list(files_from_waf(response_string, url))
+
+def is_subfolder(link, root):
+    '''
+    True if link is on the same host as root and somewhere beneath it
+    '''
+    link, root = urlparse(link), urlparse(root)
+    return (link.scheme == root.scheme and link.netloc.lower() == root.netloc.lower() and
+            link.path != root.path and link.path.startswith(root.path.rstrip('/') + '/'))
+
+def crawl_waf(url, first_page=None, max_depth=3, workers=4, open_url=read_url):
+    '''
+    Given the url of a web-accessible folder and optionally the content of its listing
+    Yields tuples: (url to get an individual record, error message) for XML files in the folder and in
+    subfolders up to max_depth levels down. Only subfolders on the same host beneath url are followed, 
+    each at most once, and up to workers listings are fetched at a time.
+    '''
+    pool = ThreadPool(max(1, workers))
+    visited = set([url])
+    found = set()
+    pending = deque()
+    if first_page is None:
+        pending.append((url, 0, pool.apply_async(open_url, (url,))))
+    else:
+        pending.append((url, 0, None))
+    
+    try:
+        while len(pending) > 0:
+            folder, depth, fetch = pending.popleft()
+            if fetch is None:
+                content = first_page
+            else:
+                try:
+                    content = fetch.get()
+                except IOError, err:
+                    yield ('', 'Could not read folder ' + folder + ': ' + str(err))
+                    continue
+            
+            if depth < max_depth:
+                for link in waf_links(content, folder, FOLDER_HREF):
+                    if link not in visited and is_subfolder(link, url):
+                        visited.add(link)
+                        pending.append((link, depth + 1, pool.apply_async(open_url, (link,))))
+            
+            for link in waf_links(content, folder):
+                if link not in found:
+                    found.add(link)
+                    yield (link, '')
+    finally:
+        pool.terminate()
+
+def harvest(url, recursive=False, max_depth=3, workers=4):
+    '''
+    Given the URL of a CSW GetRecords request or a web-accessible folder
+    Yields tuples: (url to get an individual record, error message)
+    With recursive=True, subfolders of a web-accessible folder are crawled as well.
+    '''
+    stream = open_url(url)
+    tag, prefix = sniff_root(stream)
+    
+    if tag == CSW_GETRECORDS_RESPONSE:
+        # Parse the first page as it downloads. Only the few kilobytes read while sniffing are parsed twice.
+        files = files_from_csw(url, ReplayStream(prefix, stream))
+    else:
+        response = prefix + stream.read()
+        if recursive:
+            files = crawl_waf(url, response, max_depth, workers)
+        else:
+            files = files_from_waf(response, url)
+    for file in files:
+        yield file
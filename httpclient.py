@@ -0,0 +1,284 @@
+'''
+Pooled HTTP client for listing and record fetches.
+
+A CSW harvest sends thousands of GetRecordById requests to one host, so
+connections are kept alive and reused rather than opened per request. The
+client also asks for gzip/deflate encoded responses, limits the number of
+simultaneous requests to any one host, and retries failed requests with
+exponential backoff. Counters of connections opened and reused are kept for
+monitoring.
+'''
+
+import httplib, socket, threading, time, zlib
+from urlparse import urlparse, urljoin
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+class HttpError(IOError):
+    '''
+    Raised for responses with an error status, and for requests that fail after every retry
+    '''
+    def __init__(self, url, code, msg):
+        IOError.__init__(self, msg)
+        self.url = url
+        self.code = code
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+class Response(object):
+    def __init__(self, url, status, headers, content):
+        self.url = url
+        self.status = status
+        # Header names are lower case
+        self.headers = headers
+        self.content = content
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise HttpError(self.url, self.status, 'HTTP Error %d fetching %s' % (self.status, self.url))
+        return self
+
+class StreamingResponse(Response):
+    '''
+    A Response whose body has not been read yet. read() decodes it as it arrives, so it can be handed to a
+    parser as a file-like object. The connection goes back to the pool once the body has been read to the
+    end, and is closed if the response is closed before then.
+    '''
+    CHUNK_SIZE = 65536
+
+    def __init__(self, url, status, headers, raw, release):
+        Response.__init__(self, url, status, headers, None)
+        self.raw = raw
+        self.release = release
+        self.buffer = ''
+        self.finished = False
+        self.decoder = None
+        self.encoding = headers.get('content-encoding', '').lower()
+
+    def decode(self, chunk):
+        if self.encoding == 'gzip':
+            if self.decoder is None:
+                self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            return self.decoder.decompress(chunk)
+        if self.encoding == 'deflate':
+            # As in decode_content, try a zlib stream first and fall back to raw deflate
+            if self.decoder is None:
+                self.decoder = zlib.decompressobj()
+                try:
+                    return self.decoder.decompress(chunk)
+                except zlib.error:
+                    self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self.decoder.decompress(chunk)
+        return chunk
+
+    def read(self, size=-1):
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            try:
+                chunk = self.raw.read(self.CHUNK_SIZE)
+                if chunk == '':
+                    self.finished = True
+                    if self.decoder is not None:
+                        self.buffer += self.decoder.flush()
+                    self.release(True)
+                else:
+                    self.buffer += self.decode(chunk)
+            except (httplib.HTTPException, socket.error, zlib.error), err:
+                self.close()
+                raise HttpError(self.url, self.status, 'Could not read %s: %s' % (self.url, err))
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        if not self.finished:
+            self.finished = True
+            self.release(False)
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            self.close()
+        return Response.raise_for_status(self)
+
+def decode_content(content, encoding):
+    if encoding == 'gzip':
+        return zlib.decompress(content, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        # Servers disagree about whether deflate means a zlib stream or raw deflate
+        try:
+            return zlib.decompress(content)
+        except zlib.error:
+            return zlib.decompress(content, -zlib.MAX_WBITS)
+    return content
+
+class HostLimiter(object):
+    '''
+    Hands out one bounded semaphore per host name
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.semaphores = dict()
+        self.lock = threading.Lock()
+
+    def __call__(self, url):
+        host = urlparse(url).netloc.lower()
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.limit)
+            return self.semaphores[host]
+
+class HttpClient(object):
+    def __init__(self, timeout=30, retries=2, backoff=0.5, per_host=4, user_agent='usginvalid'):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.user_agent = user_agent
+        self.limiter = HostLimiter(per_host)
+        self.idle = dict()
+        self.lock = threading.Lock()
+
+        self.requests = 0
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    def stats(self):
+        return {'requests': self.requests,
+                'connections_opened': self.connections_opened,
+                'connections_reused': self.connections_reused}
+
+    def _connection(self, key):
+        '''
+        Returns (connection, reused) for a (scheme, host) key
+        '''
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                self.connections_reused += 1
+                return idle.pop(), True
+            self.connections_opened += 1
+
+        scheme, host = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout), False
+        return httplib.HTTPConnection(host, timeout=self.timeout), False
+
+    def _release(self, key, connection):
+        with self.lock:
+            self.idle.setdefault(key, list()).append(connection)
+
+    def _request(self, url, headers, stream=False):
+        parsed = urlparse(url)
+        if parsed.scheme not in ['http', 'https']:
+            raise HttpError(url, None, 'Unsupported URL scheme: ' + url)
+        key = (parsed.scheme, parsed.netloc.lower())
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+
+        request_headers = {'Accept-Encoding': 'gzip, deflate', 'User-Agent': self.user_agent}
+        request_headers.update(headers)
+
+        with self.lock:
+            self.requests += 1
+        while True:
+            connection, reused = self._connection(key)
+            try:
+                connection.request('GET', path, headers=request_headers)
+                response = connection.getresponse()
+                if not stream:
+                    content = response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                # A kept-alive connection may have been closed by the server while idle, so try a fresh one
+                if reused:
+                    continue
+                raise
+
+            response_headers = dict((name.lower(), value) for name, value in response.getheaders())
+            if stream:
+                def release(complete, connection=connection, response=response):
+                    if complete and not response.will_close:
+                        self._release(key, connection)
+                    else:
+                        connection.close()
+                return StreamingResponse(url, response.status, response_headers, response, release)
+
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(key, connection)
+
+            content = decode_content(content, response_headers.get('content-encoding', '').lower())
+            return Response(url, response.status, response_headers, content)
+
+    def get(self, url, headers=None):
+        '''
+        Given a URL and optionally a dictionary of request headers
+        Returns a Response, following redirects. Connection failures and 5xx responses are retried.
+        '''
+        return self._get(url, headers, False)
+
+    def open(self, url, headers=None):
+        '''
+        Like get, but returns a StreamingResponse to read the body from as it downloads. The per-host
+        limit only covers sending the request and reading the headers.
+        '''
+        return self._get(url, headers, True)
+
+    def _get(self, url, headers, stream):
+        if headers is None: headers = dict()
+
+        for redirect in range(MAX_REDIRECTS + 1):
+            for attempt in range(self.retries + 1):
+                if attempt > 0:
+                    time.sleep(self.backoff * 2 ** (attempt - 1))
+                try:
+                    with self.limiter(url):
+                        response = self._request(url, headers, stream)
+                except (httplib.HTTPException, socket.error, zlib.error), err:
+                    if attempt == self.retries:
+                        raise HttpError(url, None, 'Could not fetch %s: %s' % (url, err))
+                    continue
+                if response.status < 500 or attempt == self.retries:
+                    break
+                if stream:
+                    response.close()
+
+            location = response.headers.get('location')
+            if response.status not in REDIRECT_CODES or location is None:
+                return response
+            if stream:
+                response.close()
+            url = urljoin(url, location)
+
+        raise HttpError(url, response.status, 'Too many redirects fetching ' + url)
+
+_default_client = None
+_default_lock = threading.Lock()
+
+def default_client():
+    '''
+    Returns the HttpClient shared by the whole process, configured from Django settings
+    '''
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            from django.conf import settings
+            _default_client = HttpClient(timeout=getattr(settings, 'USGINVALID_HTTP_TIMEOUT', 30),
+                                         retries=getattr(settings, 'USGINVALID_HTTP_RETRIES', 2),
+                                         backoff=getattr(settings, 'USGINVALID_HTTP_BACKOFF', 0.5),
+                                         per_host=getattr(settings, 'USGINVALID_PER_HOST_CONNECTIONS', 4))
+        return _default_client
+
+def discard_default_client():
+    '''
+    Forget the shared HttpClient without closing its connections. A forked child process must call this
+    before making requests, since its idle connections are still in use by the parent.
+    '''
+    global _default_client
+    with _default_lock:
+        _default_client = None
@@ -0,0 +1,85 @@
+'''
+Database-backed queue for ValidationJob and ValidationSet runs.
+
+Saving a job or set in the admin only marks it as queued. Worker processes,
+started with "manage.py usginvalid_worker", poll for queued rows, claim one with
+a conditional UPDATE so that no two workers run the same thing, run it, and
+record the outcome in the status fields from models.QueuedRun.
+'''
+
+import os, socket, time, datetime, traceback
+from models import ValidationJob, ValidationSet
+from runner import run_validation_job, run_validation_set
+
+# Progress on a set is written every this many records
+PROGRESS_INTERVAL = 10
+
+def worker_name():
+    return socket.gethostname() + ':' + str(os.getpid())
+
+def queued_models():
+    return [ValidationJob, ValidationSet]
+
+def claim_next(worker):
+    '''
+    Given a worker name
+    Returns the oldest queued ValidationJob or ValidationSet, now marked as running by this worker, or None
+    '''
+    for model in queued_models():
+        candidates = model.objects.filter(status='queued').order_by('queued_at').values_list('pk', flat=True)[:10]
+        for pk in candidates:
+            claimed = model.objects.filter(pk=pk, status='queued').update(status='running',
+                                                                           started_at=datetime.datetime.now(),
+                                                                           worker=worker)
+            if claimed == 1:
+                return model.objects.get(pk=pk)
+    return None
+
+def requeue_stale(max_age):
+    '''
+    Put runs back in the queue that have been running for longer than max_age (a timedelta),
+    normally because the worker running them died
+    '''
+    cutoff = datetime.datetime.now() - max_age
+    for model in queued_models():
+        model.objects.filter(status='running', started_at__lt=cutoff).update(status='queued', worker='')
+
+def set_progress(obj, done, total):
+    # Until harvesting finishes the total is unknown, so report what has been seen so far
+    if total is None:
+        total = done
+    if done == total or done % PROGRESS_INTERVAL == 0:
+        ValidationSet.objects.filter(pk=obj.pk).update(records_done=done, records_total=total)
+
+def run(obj):
+    '''
+    Run a claimed ValidationJob or ValidationSet and record how it went. If it was queued again or taken
+    over by another worker while running, its status is left alone so the newer run still happens.
+    '''
+    claimed = type(obj).objects.filter(pk=obj.pk, status='running', worker=obj.worker)
+    try:
+        if isinstance(obj, ValidationSet):
+            run_validation_set(obj, progress=lambda done, total: set_progress(obj, done, total))
+        else:
+            run_validation_job(obj)
+    except Exception, err:
+        message = traceback.format_exception_only(type(err), err)[-1].strip()
+        claimed.update(status='failed', status_message=message[:255], finished_at=datetime.datetime.now())
+        return False
+
+    claimed.update(status='done', status_message='', finished_at=datetime.datetime.now())
+    return True
+
+def work(poll=5, once=False):
+    '''
+    Claim and run queued work until interrupted. Sleeps poll seconds whenever the queue is empty.
+    With once=True, returns as soon as the queue is empty instead.
+    '''
+    worker = worker_name()
+    while True:
+        obj = claim_next(worker)
+        if obj is None:
+            if once: return
+            time.sleep(poll)
+            continue
+        run(obj)
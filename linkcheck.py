@@ -0,0 +1,152 @@
+'''
+Link checking for ValidUrlRule.
+
+The same online resource, license or service URL turns up in thousands of
+records, so a LinkChecker resolves each URL once and remembers the outcome.
+Outcomes are kept in memory and in the LinkCheckResult table, which every
+worker process shares, for USGINVALID_LINK_CHECK_TTL seconds. The URLs of a
+record are checked at the same time on a pool of threads; the shared HTTP
+client keeps the number of simultaneous requests to any one host bounded. A URL
+that another thread is already checking is waited on rather than fetched again.
+'''
+
+import datetime, hashlib, threading, time
+from multiprocessing.pool import ThreadPool
+from httpclient import default_client
+
+def url_hash(url):
+    return hashlib.sha1(url.encode('utf-8') if isinstance(url, unicode) else url).hexdigest()
+
+def fetch_status(url):
+    '''
+    Given a URL
+    Returns (passed, HTTP status or None, message). A URL passes if a GET for it succeeds with a status below 400.
+    Only the response headers are read: download links often point at archives gigabytes long.
+    '''
+    try:
+        response = default_client().open(url)
+    except IOError, err:
+        return False, None, str(err)[:255]
+    response.close()
+    return response.status < 400, response.status, ''
+
+class LinkChecker(object):
+    def __init__(self, ttl=86400, workers=8, store=True):
+        self.ttl = ttl
+        self.store = store
+        self.pool = ThreadPool(max(1, workers))
+        self.lock = threading.Lock()
+        # url: (passed, time checked)
+        self.known = dict()
+        # url: AsyncResult of a check in progress
+        self.checking = dict()
+
+    def remembered(self, urls):
+        '''
+        Returns a dictionary of passed values for those urls checked within the TTL, from memory or the database
+        '''
+        now = time.time()
+        found = dict()
+        with self.lock:
+            for url in urls:
+                if url in self.known and now - self.known[url][1] < self.ttl:
+                    found[url] = self.known[url][0]
+        
+        missing = [url for url in urls if url not in found]
+        if self.store and len(missing) > 0:
+            from models import LinkCheckResult
+            cutoff = datetime.datetime.now() - datetime.timedelta(seconds=self.ttl)
+            hashes = dict((url_hash(url), url) for url in missing)
+            stored = LinkCheckResult.objects.filter(url_hash__in=hashes.keys(), checked_at__gte=cutoff)
+            with self.lock:
+                for hash, passed, checked_at in stored.values_list('url_hash', 'passed', 'checked_at'):
+                    found[hashes[hash]] = passed
+                    # Expires when the stored result does, not a full TTL from now
+                    self.known[hashes[hash]] = (passed, time.mktime(checked_at.timetuple()))
+        return found
+
+    def check_all(self, urls):
+        '''
+        Given a list of URLs
+        Returns a dictionary of whether each one resolves, checking those not already known at the same time
+        '''
+        urls = list(set(urls))
+        results = self.remembered(urls)
+        
+        started = dict()
+        waiting = dict()
+        with self.lock:
+            for url in urls:
+                if url in results:
+                    continue
+                if url in self.checking:
+                    waiting[url] = self.checking[url]
+                else:
+                    started[url] = self.checking[url] = self.pool.apply_async(fetch_status, (url,))
+        
+        checked = dict()
+        try:
+            for url, check in started.items():
+                checked[url] = check.get()
+        finally:
+            with self.lock:
+                for url in started:
+                    if url in checked:
+                        self.known[url] = (checked[url][0], time.time())
+                    del self.checking[url]
+        for url, check in waiting.items():
+            results[url] = check.get()[0]
+        
+        for url, (passed, status, message) in checked.items():
+            results[url] = passed
+        if self.store and len(checked) > 0:
+            self.save(checked)
+        return results
+
+    def check(self, url):
+        return self.check_all([url])[url]
+
+    def save(self, checked):
+        '''
+        Given a dictionary of (passed, status, message) tuples keyed by URL
+        Replaces the stored results for those URLs
+        '''
+        from models import LinkCheckResult
+        from django.db import transaction, IntegrityError
+        
+        rows = [LinkCheckResult(url=url[:2000], url_hash=url_hash(url), passed=passed, status=status, message=message)
+                for url, (passed, status, message) in checked.items()]
+        try:
+            with transaction.commit_on_success():
+                LinkCheckResult.objects.filter(url_hash__in=[row.url_hash for row in rows]).delete()
+                LinkCheckResult.objects.bulk_create(rows)
+        except IntegrityError:
+            # Another process stored the same links first
+            pass
+
+    def close(self):
+        self.pool.terminate()
+
+_default_checker = None
+_default_lock = threading.Lock()
+
+def default_checker():
+    '''
+    Returns the LinkChecker shared by the whole process, configured from Django settings
+    '''
+    global _default_checker
+    with _default_lock:
+        if _default_checker is None:
+            from django.conf import settings
+            _default_checker = LinkChecker(ttl=getattr(settings, 'USGINVALID_LINK_CHECK_TTL', 86400),
+                                           workers=getattr(settings, 'USGINVALID_LINK_CHECK_WORKERS', 8))
+        return _default_checker
+
+def discard_default_checker():
+    '''
+    Forget the shared LinkChecker. A forked child process must call this before checking links, since the
+    threads of the parent's pool do not exist in the child.
+    '''
+    global _default_checker
+    with _default_lock:
+        _default_checker = None
@@ -0,0 +1,90 @@
+import os, csv, json, datetime, multiprocessing, traceback
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from ...models import RuleSet, ValidationSet
+from ...batch import validate_named, local_sources
+from ...runner import RecordOutcome, save_set_results, batch_size
+
+class Command(BaseCommand):
+    args = '<ruleset id> <directory, glob, tar or zip file>'
+    help = 'Validate local metadata records against a RuleSet and write the results as JSON Lines or CSV'
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes', default=multiprocessing.cpu_count(),
+                    help='Number of worker processes to validate with'),
+        make_option('--format', type='choice', choices=['jsonl', 'csv'], dest='format', default='jsonl',
+                    help='Output format: jsonl (default) or csv'),
+        make_option('--output', dest='output', default=None,
+                    help='File to write results to instead of standard output'),
+        make_option('--save', dest='save', default=None, metavar='NAME',
+                    help='Also store the results as a new ValidationSet with this name'),
+        make_option('--fail-fast', action='store_true', dest='fail_fast', default=False,
+                    help='Only find out whether each record passes: stop at, and report, its first failing rule'),
+    )
+    
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Usage: manage.py usginvalid_validate ' + self.args)
+        try:
+            ruleset = RuleSet.objects.get(pk=int(args[0]))
+        except (ValueError, RuleSet.DoesNotExist):
+            raise CommandError('No RuleSet with id ' + args[0])
+        path = args[1]
+        
+        obj = None
+        if options['save'] is not None:
+            obj = ValidationSet.objects.create(name=options['save'], ruleset=ruleset, status='running',
+                                               url='file://' + os.path.abspath(path), started_at=datetime.datetime.now())
+        
+        output = self.stdout
+        if options['output'] is not None:
+            output = open(options['output'], 'wb')
+        write = self.writer(output, options['format'])
+        
+        batch = list()
+        jobs = dict()
+        done = passed = 0
+        try:
+            results = validate_named(ruleset, local_sources(path), options['processes'], 'processes', options['fail_fast'])
+            for name, result, report in results:
+                write(name, result, report)
+                done += 1
+                passed += int(result)
+                if obj is not None:
+                    batch.append(RecordOutcome((name, ''), [(ruleset, result, report)]))
+                    if len(batch) >= batch_size():
+                        save_set_results(obj, batch, jobs, [ruleset])
+                        batch = list()
+            if obj is not None:
+                save_set_results(obj, batch, jobs, [ruleset])
+                ValidationSet.objects.filter(pk=obj.pk).update(status='done', finished_at=datetime.datetime.now(),
+                                                               records_done=done, records_total=done,
+                                                               last_result=(passed == done))
+        except (Exception, KeyboardInterrupt), err:
+            # As in jobqueue.run, a saved set must not be left 'running' forever
+            if obj is not None:
+                message = traceback.format_exception_only(type(err), err)[-1].strip()
+                ValidationSet.objects.filter(pk=obj.pk).update(status='failed', status_message=message[:255],
+                                                               finished_at=datetime.datetime.now(),
+                                                               records_done=done)
+            raise
+        finally:
+            if output is not self.stdout:
+                output.close()
+        
+        if done == 0:
+            raise CommandError('No records found in ' + path)
+        self.stderr.write('%d of %d records passed\n' % (passed, done))
+    
+    def writer(self, output, format):
+        '''
+        Returns a function writing one (name, result, report) row in the given format
+        '''
+        if format == 'csv':
+            rows = csv.writer(output)
+            rows.writerow(['source', 'passed', 'item_count', 'report'])
+            return lambda name, result, report: rows.writerow([name, int(result), len(report), 
+                                                               ' | '.join(report).encode('utf-8')])
+        
+        return lambda name, result, report: output.write(json.dumps({'source': name, 'passed': result, 
+                                                                     'report': report}) + '\n')
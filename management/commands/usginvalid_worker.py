@@ -0,0 +1,44 @@
+import datetime
+from multiprocessing import Process
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import connection
+from ... import jobqueue
+
+class Command(BaseCommand):
+    help = 'Run background workers that process queued ValidationJobs and ValidationSets'
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes', default=1,
+                    help='Number of worker processes to start'),
+        make_option('--poll', type='int', dest='poll', default=5,
+                    help='Seconds to wait between checks of an empty queue'),
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Exit when the queue is empty instead of waiting for more work'),
+        make_option('--requeue-stale', type='int', dest='stale', default=0,
+                    help='Before starting, requeue runs that have been running for more than this many minutes'),
+    )
+    
+    def handle(self, *args, **options):
+        if options['stale'] > 0:
+            jobqueue.requeue_stale(datetime.timedelta(minutes=options['stale']))
+        
+        processes = max(1, options['processes'])
+        if processes == 1:
+            jobqueue.work(poll=options['poll'], once=options['once'])
+            return
+        
+        # Each child must open its own database connection
+        connection.close()
+        workers = list()
+        for index in range(processes):
+            worker = Process(target=jobqueue.work, kwargs={'poll': options['poll'], 'once': options['once']})
+            worker.start()
+            workers.append(worker)
+            
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
@@ -1,7 +1,13 @@
-from django.db import models
+from django.db import models, connection, transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, pre_delete, post_delete
 from django.core.exceptions import ValidationError
-from xmlvalidator import *
-import datetime
+from engine import parse_record, RuleCompiler
+from django.utils.html import escape
+import datetime, threading, zlib, base64, json
+import compiled
+import graph
+import batch
 
 RULE_TYPES = (
               ('ExistsRule', 'XPath Exists'),
@@ -12,24 +18,55 @@ RULE_TYPES = (
               ('ConditionalRule', 'Conditional: Execute One Rule if Another is Valid'),
               ('ValidUrlRule', 'Check that a URL can be resolved.'))
 
+RUN_STATUSES = (
+                ('idle', 'Idle'),
+                ('queued', 'Queued'),
+                ('running', 'Running'),
+                ('done', 'Done'),
+                ('failed', 'Failed'))
+
 class RuleSet(models.Model):
     name = models.CharField(max_length=255)
     purpose = models.CharField(max_length=255)
     rules = models.ManyToManyField('Rule', through='RuleToRuleSetLink')
+    version = models.PositiveIntegerField(default=0, editable=False)
     
     def __unicode__(self):
         return self.name
     
+    def save(self, *args, **kwargs):
+        # Never write back a stale version number over one bumped by a rule change
+        if self.pk is not None:
+            current = RuleSet.objects.filter(pk=self.pk).values_list('version', flat=True)
+            if len(current) > 0 and current[0] > self.version:
+                self.version = current[0]
+        super(RuleSet, self).save(*args, **kwargs)
+    
+    def compiled_rules(self):
+        return compiled.compiled_ruleset(self)
+    
+    def load_graph(self, reload_values=False):
+        return graph.load_graph(self.rules.select_related('values'), reload_values)
+    
     def rule_list(self):
-        result = list()
-        for rule in self.rules.all():
-            result.append(rule.rule())
-            
-        return result
+        return self.compiled_rules().rules
     
-    def xml_validate(self, filepath):
-        result, report = record_is_valid(filepath, self.rule_list())
+    def xml_validate(self, source, fail_fast=False):
+        '''
+        Given a URL, file path, bytes or an already parsed engine.Record
+        Returns (result, report). Parse once with engine.parse_record to validate one record against several RuleSets.
+        With fail_fast, cheap rules run first and validation stops at the first failure.
+        '''
+        result, report = self.compiled_rules().validate(parse_record(source), fail_fast)
         return result, report
+    
+    def xml_validate_many(self, sources, workers=None, backend='threads', fail_fast=False):
+        '''
+        Given an iterable of URLs, file paths or bytes
+        Yields (source, result, report) for each as soon as it is validated. backend is 'threads', which shares
+        this process's compiled rules and HTTP connections, or 'processes', which uses every core.
+        '''
+        return batch.validate_many(self, sources, workers, backend, fail_fast)
 
 class RuleToRuleSetLink(models.Model):
     class Meta:
@@ -81,24 +118,10 @@ class Rule(models.Model):
         return self.xpath_set.all().values_list('xpath', flat=True)
         
     def rule(self):
-        if self.type == 'ExistsRule': 
-            return ExistsRule(self.name, self.description, self.xpath_list()[0])
-        if self.type == 'ValueInListRule':
-            return ValueInListRule(self.name, self.description, self.xpath_list()[0], self.values.values_list())
-        if self.type == 'AnyOfRule':
-            if self.context == None:
-                context = '/'
-            else:
-                context = self.context
-            return AnyOfRule(self.name, self.description, self.xpath_list(), context)
-        if self.type == 'OneOfRule':
-            return OneOfRule(self.name, self.description, self.xpath_list())
-        if self.type == 'ContentMatchesExpressionRule':
-            return ContentMatchesExpressionRule(self.name, self.description, self.xpath_list()[0], self.regex)
-        if self.type == 'ConditionalRule':
-            return ConditionalRule(self.name, self.description, [self.condition_rule.rule(), self.requirement_rule.rule()])
-        if self.type == 'ValidUrlRule':
-            return ValidUrlRule(self.name, self.description, self.xpath_list()[0])
+        '''
+        Returns the compiled engine rule for this rule and any rules it depends on
+        '''
+        return RuleCompiler().rule(graph.load_graph([self]).rules[0])
             
     def clean(self):
         # Make sure that only appropriate fields are populated depending on the type of rule
@@ -187,6 +210,16 @@ class ValidValue(models.Model):
     def __unicode__(self):
         return self.value
 
+def pack_items(items):
+    '''
+    Given a list of report messages
+    Returns them as one compact string for ValidationReport.packed_items
+    '''
+    return base64.b64encode(zlib.compress(json.dumps(list(items)), 9))
+
+def unpack_items(packed):
+    return json.loads(zlib.decompress(base64.b64decode(packed)))
+
 class ValidationReportItem(models.Model):
     item = models.CharField(max_length=255)
     report = models.ForeignKey('ValidationReport', editable=False)
@@ -200,29 +233,182 @@ class ValidationReport(models.Model):
         
     run_date = models.DateTimeField(editable=False, default=datetime.datetime.now)
     job = models.ForeignKey('ValidationJob', editable=False)
+    # Which of the job's rule sets this report is for. Empty for reports made before jobs had several.
+    ruleset = models.ForeignKey('RuleSet', blank=True, null=True, editable=False)
+    passed = models.BooleanField(verbose_name='Valid', editable=False, default=False)
+    item_count = models.PositiveIntegerField(default=0, editable=False)
+    # Compressed list of messages when stored in 'packed' mode, otherwise empty. See pack_items.
+    packed_items = models.TextField(blank=True, editable=False)
     
     def __unicode__(self):
         return self.job.name + ' -on- ' + str(self.run_date)
     
-class ValidationJob(models.Model):
+    def items(self):
+        '''
+        Returns the list of report messages, however they are stored
+        '''
+        if self.packed_items != '':
+            return unpack_items(self.packed_items)
+        return list(self.validationreportitem_set.values_list('item', flat=True))
+    
+    def items_display(self):
+        # Reports stored as rows are shown by the item inline instead
+        if self.packed_items == '':
+            return ''
+        return '<ul>' + ''.join(['<li>%s</li>' % escape(item) for item in self.items()]) + '</ul>'
+    items_display.allow_tags = True
+    items_display.short_description = 'Report'
+    
+def report_items(reports):
+    '''
+    Given ValidationReports
+    Returns a dictionary of each report's messages keyed by report primary key, reading the items of
+    reports stored as rows with a single query
+    '''
+    result = dict()
+    rows = list()
+    for report in reports:
+        if report.packed_items != '':
+            result[report.pk] = unpack_items(report.packed_items)
+        else:
+            result[report.pk] = list()
+            rows.append(report.pk)
+    if len(rows) > 0:
+        items = ValidationReportItem.objects.filter(report__in=rows).order_by('pk').values_list('report', 'item')
+        for report_pk, item in items:
+            result[report_pk].append(item)
+    return result
+
+def refresh_latest_reports(job_pks):
+    '''
+    Given primary keys of ValidationJobs
+    Points each of them at its newest ValidationReport, with a single UPDATE
+    '''
+    job_pks = list(job_pks)
+    if len(job_pks) == 0:
+        return
+    
+    quote = connection.ops.quote_name
+    jobs, reports = ValidationJob._meta, ValidationReport._meta
+    sql = ('UPDATE %(jobs)s SET %(latest)s = (SELECT MAX(%(report_pk)s) FROM %(reports)s WHERE %(reports)s.%(job)s = %(jobs)s.%(job_pk)s) '
+           'WHERE %(job_pk)s IN (%(params)s)') % {'jobs': quote(jobs.db_table), 
+                                                  'reports': quote(reports.db_table),
+                                                  'latest': quote(jobs.get_field('latest_report').column),
+                                                  'job_pk': quote(jobs.pk.column),
+                                                  'report_pk': quote(reports.pk.column),
+                                                  'job': quote(reports.get_field('job').column),
+                                                  'params': ', '.join(['%s'] * len(job_pks))}
+    connection.cursor().execute(sql, job_pks)
+    transaction.commit_unless_managed()
+
+def bulk_update(model, objects, fields):
+    '''
+    Given a model class, a list of saved instances of it and the names of fields that changed
+    Writes those fields for every instance with as few UPDATE statements as the database's parameter limit allows
+    '''
+    objects = list(objects)
+    if len(objects) == 0:
+        return
+    
+    quote = connection.ops.quote_name
+    meta = model._meta
+    fields = [meta.get_field(name) for name in fields]
+    # SQLite allows at most 999 parameters in a statement
+    chunk = max(1, 999 // (2 * len(fields) + 1))
+    for start in range(0, len(objects), chunk):
+        rows = objects[start:start + chunk]
+        assignments = list()
+        params = list()
+        for field in fields:
+            assignments.append('%s = CASE %s %s END' % (quote(field.column), quote(meta.pk.column), 
+                                                        ' '.join(['WHEN %s THEN %s'] * len(rows))))
+            for row in rows:
+                params.extend([row.pk, field.get_db_prep_save(getattr(row, field.attname), connection)])
+        params.extend([row.pk for row in rows])
+        sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (quote(meta.db_table), ', '.join(assignments), 
+                                                     quote(meta.pk.column), ', '.join(['%s'] * len(rows)))
+        connection.cursor().execute(sql, params)
+    transaction.commit_unless_managed()
+
+class LinkCheckResult(models.Model):
+    '''
+    Whether a URL found by a ValidUrlRule could be resolved when it was last checked. See linkcheck.py
+    '''
+    class Meta:
+        ordering = ['url']
+        
+    url = models.TextField(editable=False)
+    # sha1 of the url, since URLs can be too long to index
+    url_hash = models.CharField(max_length=40, unique=True, editable=False)
+    passed = models.BooleanField(editable=False, default=False)
+    status = models.PositiveIntegerField(blank=True, null=True, editable=False)
+    message = models.CharField(max_length=255, blank=True, editable=False)
+    checked_at = models.DateTimeField(default=datetime.datetime.now, db_index=True, editable=False)
+    
+    def __unicode__(self):
+        return self.url
+    
+class QueuedRun(models.Model):
+    '''
+    Status fields shared by everything the background workers can run. See jobqueue.py
+    '''
+    class Meta:
+        abstract = True
+        
+    status = models.CharField(max_length=20, choices=RUN_STATUSES, default='idle', editable=False)
+    status_message = models.CharField(max_length=255, blank=True, editable=False)
+    queued_at = models.DateTimeField(blank=True, null=True, editable=False)
+    started_at = models.DateTimeField(blank=True, null=True, editable=False)
+    finished_at = models.DateTimeField(blank=True, null=True, editable=False)
+    worker = models.CharField(max_length=255, blank=True, editable=False)
+    
+    def enqueue(self):
+        self.status = 'queued'
+        self.status_message = ''
+        self.queued_at = datetime.datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self.worker = ''
+        self.save()
+    
+class ValidationJob(QueuedRun):
     class Meta:
         ordering = ['name']
         
     name = models.CharField(max_length=255)
     ruleset = models.ForeignKey('RuleSet')
+    extra_rulesets = models.ManyToManyField('RuleSet', blank=True, related_name='extra_jobs', verbose_name='Other rule sets',
+                                            help_text='Also validate against these rule sets. Each rule set gets its own report.')
     url = models.URLField()
     last_result = models.BooleanField(verbose_name='Valid', editable=False, default=False)
     set = models.ForeignKey('ValidationSet', blank=True, null=True)
+    
+    # What the last report was made from. See runner.validate_file
+    content_hash = models.CharField(max_length=40, blank=True, editable=False)
+    etag = models.CharField(max_length=255, blank=True, editable=False)
+    last_modified = models.CharField(max_length=255, blank=True, editable=False)
+    ruleset_version = models.PositiveIntegerField(blank=True, null=True, editable=False)
+    ruleset_signature = models.CharField(max_length=255, blank=True, editable=False)
+    # Kept up to date by refresh_latest_reports whenever reports are written
+    latest_report = models.ForeignKey('ValidationReport', blank=True, null=True, editable=False, 
+                                      related_name='+', on_delete=models.SET_NULL)
         
     def __unicode__(self):
         return self.name
     
+    def rulesets(self):
+        '''
+        Returns the RuleSets to validate against: the job's set's if it belongs to one, otherwise its own
+        '''
+        if self.set_id is not None:
+            return self.set.rulesets()
+        return [self.ruleset] + list(self.extra_rulesets.exclude(pk=self.ruleset_id).order_by('pk'))
+    
     def last_report_link(self):
-        last_report = self.validationreport_set.all()
-        if len(last_report) == 0: 
+        if self.latest_report_id is None: 
             return 'Never'
         
-        last_report = last_report[len(last_report)-1]
+        last_report = self.latest_report
         result = '<a href="/admin/usginvalid/validationreport/' + str(last_report.pk) + '/">' + str(last_report.run_date) + '</a>'
         return result
     last_report_link.allow_tags = True
@@ -236,19 +422,104 @@ class ValidationJob(models.Model):
     set_link.allow_tags = True
     set_link.short_description = 'Validation Set'
     
-class ValidationSet(models.Model):
+class ValidationSet(QueuedRun):
     class Meta:
         ordering = ['name']
         
     name = models.CharField(max_length=255)
     ruleset = models.ForeignKey('RuleSet')
+    extra_rulesets = models.ManyToManyField('RuleSet', blank=True, related_name='extra_sets', verbose_name='Other rule sets',
+                                            help_text='Also validate against these rule sets. Each rule set gets its own report.')
     url = models.URLField()
     last_result = models.BooleanField(verbose_name='Valid', editable=False, default=False)
+    recursive = models.BooleanField(default=False,
+                                    help_text='Web-Accessible Folders Only: Also validate XML files in subfolders.')
+    max_depth = models.PositiveIntegerField(default=3,
+                                            help_text='Web-Accessible Folders Only: How many levels of subfolders to follow when recursive.')
+    cache_only = models.BooleanField(default=False,
+                                     help_text='Validate the records found by the last run from the local record cache, without contacting the catalog.')
+    records_done = models.PositiveIntegerField(default=0, editable=False)
+    records_total = models.PositiveIntegerField(default=0, editable=False)
     
     def __unicode__(self):
         return self.name
-        
-        
-         
-        
-        
\ No newline at end of file
+    
+    def rulesets(self):
+        '''
+        Returns the RuleSets every record in the set is validated against, primary rule set first
+        '''
+        return [self.ruleset] + list(self.extra_rulesets.exclude(pk=self.ruleset_id).order_by('pk'))
+    
+    def progress(self):
+        if self.status in ['idle', 'queued']:
+            return ''
+        return str(self.records_done) + ' / ' + str(self.records_total)
+    progress.short_description = 'Progress'
+
+def rulesets_using(rule_pks):
+    '''
+    Given primary keys of Rules
+    Returns a queryset of the RuleSets that include any of them, directly or as the condition or requirement
+    of a ConditionalRule, however deeply nested
+    '''
+    reached = set(rule_pks)
+    new = set(rule_pks)
+    while len(new) > 0:
+        parents = Rule.objects.filter(Q(condition_rule__in=new) | Q(requirement_rule__in=new)).values_list('pk', flat=True)
+        new = set(parents) - reached
+        reached |= new
+    links = RuleToRuleSetLink.objects.filter(rule__in=reached).values_list('ruleset', flat=True)
+    return RuleSet.objects.filter(pk__in=set(links))
+
+def invalidate_compiled_rulesets(sender, instance, **kwargs):
+    # Only the rule sets that can reach the changed rule or value set get a new version
+    if isinstance(instance, RuleToRuleSetLink):
+        rulesets = RuleSet.objects.filter(pk=instance.ruleset_id)
+    elif isinstance(instance, Rule):
+        rulesets = rulesets_using([instance.pk])
+    elif isinstance(instance, XPath):
+        rulesets = rulesets_using([instance.rule_id])
+    elif isinstance(instance, ValidValue):
+        rulesets = rulesets_using(Rule.objects.filter(values=instance.set_id).values_list('pk', flat=True))
+    else:
+        rulesets = rulesets_using(Rule.objects.filter(values=instance.pk).values_list('pk', flat=True))
+    rulesets.update(version=models.F('version') + 1)
+    compiled.invalidate()
+
+for rule_model in [Rule, XPath, ValidValue, ValidValuesSet, RuleToRuleSetLink]:
+    post_save.connect(invalidate_compiled_rulesets, sender=rule_model)
+    post_delete.connect(invalidate_compiled_rulesets, sender=rule_model)
+
+def invalidate_valid_values(sender, instance, **kwargs):
+    if isinstance(instance, ValidValue):
+        compiled.invalidate_value_table(instance.set_id)
+    else:
+        compiled.invalidate_value_table(instance.pk)
+
+for values_model in [ValidValue, ValidValuesSet]:
+    post_save.connect(invalidate_valid_values, sender=values_model)
+    post_delete.connect(invalidate_valid_values, sender=values_model)
+
+# Jobs being deleted in this thread. Their reports go with them, so there is no latest report to refresh.
+_deleting = threading.local()
+
+def deleting_jobs():
+    if not hasattr(_deleting, 'jobs'):
+        _deleting.jobs = set()
+    return _deleting.jobs
+
+def note_job_deletion(sender, instance, **kwargs):
+    deleting_jobs().add(instance.pk)
+
+def forget_job_deletion(sender, instance, **kwargs):
+    deleting_jobs().discard(instance.pk)
+
+pre_delete.connect(note_job_deletion, sender=ValidationJob)
+post_delete.connect(forget_job_deletion, sender=ValidationJob)
+
+# Reports are created in batches by runner.save_reports, which refreshes the jobs itself
+def refresh_latest_report(sender, instance, **kwargs):
+    if instance.job_id not in deleting_jobs():
+        refresh_latest_reports([instance.job_id])
+
+post_delete.connect(refresh_latest_report, sender=ValidationReport)
@@ -0,0 +1,153 @@
+'''
+On-disk cache of fetched records.
+
+Records are stored by the sha1 of their content under objects/, so a record
+served at several URLs is stored once. For each URL an entry under index/
+remembers the ETag and Last-Modified values it was served with and the hash of
+its content. With a cache configured, fetch.fetch_record sends those validators
+on the next request and takes the content from disk when the server answers 304.
+A ValidationSet can also be run from the cache alone, without any requests.
+
+When the objects grow beyond USGINVALID_RECORD_CACHE_SIZE bytes, the least
+recently used ones are removed. Reading an object updates its modification time,
+which is what "recently used" means here.
+'''
+
+import os, json, hashlib, tempfile, threading
+
+class CachedRecord(object):
+    def __init__(self, url, content_hash, etag='', last_modified=''):
+        self.url = url
+        self.content_hash = content_hash
+        self.etag = etag
+        self.last_modified = last_modified
+
+def sha1(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return hashlib.sha1(value).hexdigest()
+
+class RecordCache(object):
+    # Eviction removes objects until they fit in this fraction of max_bytes, so it does not run on every write
+    LOW_WATER = 0.9
+    
+    def __init__(self, root, max_bytes=1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.size = sum(size for path, size, used in self.objects())
+
+    def path(self, kind, key):
+        return os.path.join(self.root, kind, key[:2], key)
+
+    def write(self, path, content):
+        # Written to a temporary file and renamed, so readers never see part of a file
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                if not os.path.isdir(folder): raise
+        handle, temporary = tempfile.mkstemp(dir=folder)
+        with os.fdopen(handle, 'wb') as output:
+            output.write(content)
+        os.rename(temporary, path)
+
+    def get(self, url):
+        '''
+        Given a URL
+        Returns a CachedRecord for it, or None if it has not been cached or its content has since been evicted
+        '''
+        try:
+            with open(self.path('index', sha1(url)), 'rb') as index:
+                entry = json.load(index)
+        except (IOError, ValueError):
+            return None
+        if entry.get('url') != url or not os.path.exists(self.path('objects', entry['content_hash'])):
+            return None
+        return CachedRecord(url, entry['content_hash'], entry.get('etag', ''), entry.get('last_modified', ''))
+
+    def content(self, entry):
+        '''
+        Given a CachedRecord
+        Returns the content of the record, or None if it has been evicted
+        '''
+        path = self.path('objects', entry.content_hash)
+        try:
+            with open(path, 'rb') as cached:
+                content = cached.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return content
+
+    def put(self, url, content, etag='', last_modified=''):
+        '''
+        Store the content fetched from a URL, along with the validators it was served with
+        '''
+        content_hash = sha1(content)
+        path = self.path('objects', content_hash)
+        if os.path.exists(path):
+            os.utime(path, None)
+        else:
+            self.write(path, content)
+            with self.lock:
+                self.size += len(content)
+        
+        entry = {'url': url, 'content_hash': content_hash, 'etag': etag or '', 'last_modified': last_modified or ''}
+        self.write(self.path('index', sha1(url)), json.dumps(entry))
+        if self.size > self.max_bytes:
+            self.evict()
+        return CachedRecord(url, content_hash, entry['etag'], entry['last_modified'])
+
+    def objects(self):
+        '''
+        Yields (path, size, last used) for every stored record
+        '''
+        top = os.path.join(self.root, 'objects')
+        if not os.path.isdir(top):
+            return
+        for folder in os.listdir(top):
+            for name in os.listdir(os.path.join(top, folder)):
+                path = os.path.join(top, folder, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def evict(self):
+        '''
+        Remove the least recently used records until the cache is back under its size limit. Index entries
+        for removed records are left behind; get() ignores them and the next put() replaces them.
+        '''
+        with self.lock:
+            # Other processes may share the directory, so measure it rather than trusting self.size
+            stored = sorted(self.objects(), key=lambda item: item[2])
+            size = sum(item[1] for item in stored)
+            for path, object_size, used in stored:
+                if size <= self.max_bytes * self.LOW_WATER:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                size -= object_size
+            self.size = size
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+def default_cache():
+    '''
+    Returns the RecordCache in the USGINVALID_RECORD_CACHE directory, or None if no directory is configured
+    '''
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            from django.conf import settings
+            root = getattr(settings, 'USGINVALID_RECORD_CACHE', None)
+            if root is None:
+                return None
+            _default_cache = RecordCache(root, getattr(settings, 'USGINVALID_RECORD_CACHE_SIZE', 1024 ** 3))
+        return _default_cache
@@ -0,0 +1,259 @@
+'''
+Concurrent validation of harvested records.
+
+Fetching a record is almost all network wait, so records are validated on a
+pool of threads. Results come back in the same order as the input so callers
+can persist them exactly as the old serial loop did. Records are fetched through
+the shared client in httpclient.py, which keeps the pool from opening more than
+a handful of simultaneous connections to any one server.
+'''
+
+import datetime
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from models import ValidationJob, ValidationReport, ValidationReportItem, pack_items, refresh_latest_reports, bulk_update
+from fetch import fetch_record
+from recordcache import default_cache
+from engine import Record, ValidationException
+from compiled import compiled_group, ruleset_signature
+from harvest import harvest
+from batch import default_workers
+
+def report_storage():
+    # 'rows' keeps one ValidationReportItem per message, 'packed' compresses them into the ValidationReport
+    return getattr(settings, 'USGINVALID_REPORT_STORAGE', 'rows')
+
+def batch_size():
+    return getattr(settings, 'USGINVALID_WRITE_BATCH_SIZE', 100)
+
+PASSED_MESSAGE = 'Passed Validation Without Errors'
+
+class RecordOutcome(object):
+    '''
+    The result of checking one harvested file: a (RuleSet, result, report) tuple for each rule set it was
+    validated against. When reused is True the record and the rule sets are all unchanged since the job's
+    last run, so there are no results and the old reports stand.
+    '''
+    def __init__(self, file, results=None, record=None, reused=False):
+        self.file = file
+        self.results = results or list()
+        self.record = record
+        self.reused = reused
+
+    @property
+    def result(self):
+        return all(result for ruleset, result, report in self.results)
+
+    def update_job(self, job, rulesets):
+        # Remember what was validated so the next run can skip it if nothing changes
+        job.last_result = self.result
+        job.ruleset_version = rulesets[0].version
+        job.ruleset_signature = ruleset_signature(rulesets)
+        if self.record is not None:
+            job.content_hash = self.record.content_hash
+            job.etag = self.record.etag
+            job.last_modified = self.record.last_modified
+        else:
+            job.content_hash = job.etag = job.last_modified = ''
+
+# The ValidationJob fields set by RecordOutcome.update_job
+OUTCOME_FIELDS = ['last_result', 'ruleset_version', 'ruleset_signature', 'content_hash', 'etag', 'last_modified']
+
+def failed(rulesets, message):
+    return [(ruleset, False, [message]) for ruleset in rulesets]
+
+def validate_file(rulesets, file, previous=None, cache_only=False):
+    '''
+    Given a list of RuleSets, a (url, error message) tuple from one of the file_list functions and
+    optionally the existing ValidationJob for the file
+    Returns a RecordOutcome. Results are the same as the serial loop in ValidationSetAdmin used to produce.
+    Records are read through the record cache if one is configured, and only from it with cache_only.
+    The record is fetched and parsed once and checked against every rule set together, so rules the
+    sets have in common run once.
+    '''
+    if file[0] == '':
+        return RecordOutcome(file, failed(rulesets, 'Parser error: ' + file[1]))
+    
+    # Only ask for a 304 if the previous reports were made with the current rules
+    current = previous is not None and previous.ruleset_signature == ruleset_signature(rulesets)
+    try:
+        if current:
+            record = fetch_record(file[0], previous.etag, previous.last_modified, default_cache(), cache_only)
+        else:
+            record = fetch_record(file[0], cache=default_cache(), cache_only=cache_only)
+    except IOError, err:
+        return RecordOutcome(file, failed(rulesets, 'Validation Error: ' + str(err)))
+    
+    if current and (record.not_modified or record.content_hash == previous.content_hash):
+        return RecordOutcome(file, record=record, reused=True)
+    
+    try:
+        outcomes = compiled_group(rulesets).validate(Record.from_bytes(record.content, file[0]))
+    except ValidationException, err:
+        return RecordOutcome(file, failed(rulesets, 'Validation Error: '  + err.msg), record)
+    return RecordOutcome(file, [(ruleset, result, report) for ruleset, (result, report) in zip(rulesets, outcomes)], record)
+
+def validate_files(rulesets, files, workers=None, previous=None, cache_only=False):
+    '''
+    Given a list of RuleSets, an iterable of (url, error message) tuples and optionally a dictionary of existing
+    ValidationJobs keyed by url
+    Yields a RecordOutcome for each file, in input order, while later files are still being validated
+    '''
+    if workers is None: workers = default_workers()
+    if previous is None: previous = dict()
+
+    # Compile in this thread so that workers only need the database to remember link checks
+    compiled_group(rulesets)
+
+    # Files are pulled from the iterable only as workers free up, so a streaming harvest
+    # is never read far ahead of validation and any error it raises surfaces here
+    workers = max(1, workers)
+    pool = ThreadPool(workers)
+    pending = deque()
+    try:
+        for file in files:
+            pending.append(pool.apply_async(validate_file, (rulesets, file, previous.get(file[0]), cache_only)))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+def save_reports(results):
+    '''
+    Given a list of (ValidationJob, RuleSet or None, result, list of report messages) tuples
+    Creates a ValidationReport for each, all in one statement. In 'rows' storage mode the new reports are
+    read back and all of their items inserted in one more statement; in 'packed' mode the messages are
+    compressed into the reports themselves. Each job's latest_report is then updated, in one more statement.
+    '''
+    packed = report_storage() == 'packed'
+    reports = list()
+    messages = list()
+    for job, ruleset, result, report in results:
+        if len(report) == 0:
+            report = [PASSED_MESSAGE]
+        reports.append(ValidationReport(job=job, ruleset=ruleset, run_date=datetime.datetime.now(), passed=result,
+                                        item_count=len(report), packed_items=pack_items(report) if packed else ''))
+        messages.append(report)
+    if len(reports) == 0:
+        return reports
+    
+    job_pks = set(report.job_id for report in reports)
+    if packed:
+        ValidationReport.objects.bulk_create(reports)
+        refresh_latest_reports(job_pks)
+        return reports
+    
+    before = ValidationReport.objects.aggregate(last=Max('pk'))['last'] or 0
+    ValidationReport.objects.bulk_create(reports)
+    
+    # bulk_create does not set primary keys, so read the reports back and match them up in insertion order
+    created = dict()
+    for report in ValidationReport.objects.filter(pk__gt=before, job__in=job_pks).order_by('pk'):
+        created.setdefault((report.job_id, report.ruleset_id), list()).append(report)
+    reports = [created[(report.job_id, report.ruleset_id)].pop(0) for report in reports]
+    
+    items = list()
+    for report, report_messages in zip(reports, messages):
+        items.extend(ValidationReportItem(item=item, report=report) for item in report_messages)
+    ValidationReportItem.objects.bulk_create(items)
+    refresh_latest_reports(job_pks)
+    return reports
+
+def save_report(job, result, report, ruleset=None):
+    '''
+    Given a ValidationJob, its result, a list of report messages and optionally the RuleSet they came from
+    Creates a new ValidationReport holding the messages
+    '''
+    return save_reports([(job, ruleset, result, report)])[0]
+
+def run_validation_job(job):
+    '''
+    Validate a single ValidationJob and record one report per rule set, unless neither the record nor its
+    rule sets changed
+    '''
+    rulesets = job.rulesets()
+    outcome = validate_file(rulesets, (job.url, ''), job)
+    if outcome.reused:
+        return
+    
+    # Only the result fields are written, so edits made to the job while it ran are kept
+    outcome.update_job(job, rulesets)
+    ValidationJob.objects.filter(pk=job.pk).update(**dict((field, getattr(job, field)) for field in OUTCOME_FIELDS))
+    save_reports([(job,) + result for result in outcome.results])
+
+def run_validation_set(obj, progress=None):
+    '''
+    Harvest and validate every record in a ValidationSet, creating or updating one ValidationJob per record.
+    Records that are unchanged since the last run against the same rule set version keep their old report.
+    If given, progress(done, total) is called as records complete. The total is None until harvesting finishes.
+    With cache_only set, the records of the last run are validated again from the record cache, and neither
+    the catalog nor the records are requested.
+    '''
+    # Every existing job, loaded once and kept up to date as new ones are created
+    jobs = dict((job.name, job) for job in obj.validationjob_set.all())
+    rulesets = obj.rulesets()
+    
+    if obj.cache_only:
+        if default_cache() is None:
+            raise ValueError('Validating from the cache needs USGINVALID_RECORD_CACHE to be set')
+        files = [(job.url, '') for name, job in sorted(jobs.items())]
+    else:
+        files = harvest(obj.url, obj.recursive, obj.max_depth, default_workers())
+    if progress is not None: progress(0, None)
+    
+    batch = list()
+    done = 0
+    for outcome in validate_files(rulesets, files, previous=dict(jobs), cache_only=obj.cache_only):
+        batch.append(outcome)
+        if len(batch) >= batch_size():
+            save_set_results(obj, batch, jobs, rulesets)
+            done += len(batch)
+            batch = list()
+            if progress is not None: progress(done, None)
+            
+    save_set_results(obj, batch, jobs, rulesets)
+    done += len(batch)
+    if progress is not None: progress(done, done)
+
+# Everything update_job changes on an existing job
+JOB_RESULT_FIELDS = ['ruleset'] + OUTCOME_FIELDS
+
+def save_set_results(obj, batch, jobs, rulesets):
+    '''
+    Given a ValidationSet, a list of RecordOutcomes, a dictionary of the set's ValidationJobs keyed by name
+    and the RuleSets the outcomes were validated against
+    Writes the jobs and reports for the whole batch in one transaction. New jobs are inserted together and
+    added to the dictionary; existing jobs are updated together.
+    '''
+    with transaction.commit_on_success():
+        created = dict()
+        updated = dict()
+        results = list()
+        for outcome in batch:
+            if outcome.reused:
+                continue
+            
+            # Find an old Job or create a new one
+            name = outcome.file[0]
+            job = jobs.get(name) or created.get(name)
+            if job is None:
+                job = ValidationJob(set=obj, name=name, ruleset=obj.ruleset, url=name)
+                created[name] = job
+            elif job.pk is not None:
+                job.ruleset = obj.ruleset
+                updated[job.pk] = job
+            outcome.update_job(job, rulesets)
+            results.append((name, outcome))
+        
+        if len(created) > 0:
+            ValidationJob.objects.bulk_create(created.values())
+            # bulk_create does not set primary keys, so read them back
+            for job in obj.validationjob_set.filter(name__in=created.keys()):
+                jobs[job.name] = job
+        bulk_update(ValidationJob, updated.values(), JOB_RESULT_FIELDS)
+        save_reports([(jobs[name],) + result for name, outcome in results for result in outcome.results])
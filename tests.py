@@ -14,3 +14,742 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+from models import pack_items, unpack_items, RuleSet, Rule, XPath, RuleToRuleSetLink, ValidValuesSet, ValidValue, ValidationJob, ValidationSet, LinkCheckResult
+import jobqueue
+from StringIO import StringIO
+from harvest import files_from_csw, page_url, crawl_waf, sniff_root, ReplayStream, links_from_waf, links_from_waf_soup, waf_links, FOLDER_HREF
+from lxml import etree
+import harvest
+from httpclient import HttpClient, HttpError, StreamingResponse, Response, discard_default_client
+import httpclient
+from engine import ValidationException, split_steps, parse_record, RuleCompiler, Record
+from batch import local_sources
+from runner import save_report, save_reports, save_set_results, run_validation_job, RecordOutcome
+from linkcheck import LinkChecker, url_hash
+from recordcache import RecordCache, sha1
+from fetch import fetch_record
+from compiled import compiled_group, ruleset_signature
+from views import job_results
+import views
+from django.core.management import call_command
+from django.db.models import F
+from django.db import connection
+import os, gzip, json, shutil, tarfile, tempfile, zipfile, zlib, datetime, time, threading
+import BaseHTTPServer, SocketServer
+
+class CompiledRuleSetTest(TestCase):
+    def setUp(self):
+        self.ruleset = RuleSet.objects.create(name='Test Rules', purpose='Testing')
+        self.rule = Rule.objects.create(name='Has File Identifier', description='File identifier exists', type='ExistsRule')
+        XPath.objects.create(xpath='//gmd:MD_Metadata/gmd:fileIdentifier/gco:CharacterString', rule=self.rule)
+        RuleToRuleSetLink.objects.create(ruleset=self.ruleset, rule=self.rule)
+        self.ruleset = RuleSet.objects.get(pk=self.ruleset.pk)
+        
+    def test_compiled_rules_are_cached(self):
+        first = self.ruleset.compiled_rules()
+        self.assertEqual(len(first), 1)
+        self.assertTrue(self.ruleset.compiled_rules() is first)
+        
+    def test_rule_change_invalidates_cache(self):
+        first = self.ruleset.compiled_rules()
+        self.rule.description = 'Changed'
+        self.rule.save()
+        
+        ruleset = RuleSet.objects.get(pk=self.ruleset.pk)
+        self.assertTrue(ruleset.version > first.version)
+        self.assertFalse(ruleset.compiled_rules() is first)
+        
+    def test_unrelated_change_keeps_version(self):
+        version = RuleSet.objects.get(pk=self.ruleset.pk).version
+        other = Rule.objects.create(name='Has Title', description='Title exists', type='ExistsRule')
+        XPath.objects.create(xpath='//gmd:MD_Metadata//gmd:title/gco:CharacterString', rule=other)
+        self.assertEqual(RuleSet.objects.get(pk=self.ruleset.pk).version, version)
+        
+        # Rules reached through a conditional rule count as part of the set
+        conditional = Rule.objects.create(name='Titled Records', description='Records with identifiers have titles', 
+                                          type='ConditionalRule', condition_rule=self.rule, requirement_rule=other)
+        RuleToRuleSetLink.objects.create(ruleset=self.ruleset, rule=conditional)
+        version = RuleSet.objects.get(pk=self.ruleset.pk).version
+        other.description = 'Changed'
+        other.save()
+        self.assertTrue(RuleSet.objects.get(pk=self.ruleset.pk).version > version)
+
+class RuleGraphTest(TestCase):
+    def setUp(self):
+        self.ruleset = RuleSet.objects.create(name='Test Rules', purpose='Testing')
+        codes = ValidValuesSet.objects.create(name='Language Codes')
+        for value in ['eng', 'spa', 'fre']:
+            ValidValue.objects.create(value=value, set=codes)
+        
+        exists = Rule.objects.create(name='Is a Dataset', description='Record describes a dataset', type='ExistsRule')
+        XPath.objects.create(xpath='//gmd:MD_Metadata/gmd:identificationInfo/gmd:MD_DataIdentification', rule=exists)
+        language = Rule.objects.create(name='Language is Valid', description='Language code is valid', type='ValueInListRule', values=codes)
+        XPath.objects.create(xpath='//gmd:MD_Metadata/gmd:language/gco:CharacterString', rule=language)
+        conditional = Rule.objects.create(name='Dataset Language', description='Datasets need a valid language', 
+                                          type='ConditionalRule', condition_rule=exists, requirement_rule=language)
+        RuleToRuleSetLink.objects.create(ruleset=self.ruleset, rule=conditional)
+        RuleToRuleSetLink.objects.create(ruleset=self.ruleset, rule=language)
+        
+    def test_graph_resolves_dependencies(self):
+        rules = dict((node.name, node) for node in self.ruleset.load_graph())
+        conditional = rules['Dataset Language']
+        self.assertEqual(conditional.condition.xpaths, ['//gmd:MD_Metadata/gmd:identificationInfo/gmd:MD_DataIdentification'])
+        self.assertTrue(conditional.requirement is rules['Language is Valid'])
+        self.assertEqual(sorted(conditional.requirement.values), ['eng', 'fre', 'spa'])
+        
+    def test_graph_query_count(self):
+        # Rules, one level of conditional sub-rules, XPaths and valid values
+        self.assertNumQueries(4, self.ruleset.load_graph)
+        # The valid values are cached once loaded
+        self.assertNumQueries(3, self.ruleset.load_graph)
+        
+    def test_value_tables_are_shared(self):
+        first = dict((node.name, node) for node in self.ruleset.load_graph())['Language is Valid']
+        second = dict((node.name, node) for node in self.ruleset.load_graph())['Language is Valid']
+        self.assertTrue(isinstance(first.values, frozenset))
+        self.assertTrue(first.values is second.values)
+        
+        ValidValue.objects.create(value='ger', set=ValidValuesSet.objects.get(name='Language Codes'))
+        third = dict((node.name, node) for node in self.ruleset.load_graph())['Language is Valid']
+        self.assertTrue('ger' in third.values)
+        
+    def test_values_changed_elsewhere(self):
+        self.ruleset.compiled_rules()
+        
+        # Another process adds a value: no signals fire here, only the rule set version is bumped
+        ValidValue.objects.bulk_create([ValidValue(value='ita', set=ValidValuesSet.objects.get(name='Language Codes'))])
+        RuleSet.objects.filter(pk=self.ruleset.pk).update(version=F('version') + 1)
+        
+        compiled = RuleSet.objects.get(pk=self.ruleset.pk).compiled_rules()
+        language = dict((node.name, node) for node in compiled.graph)['Language is Valid']
+        self.assertTrue('ita' in language.values)
+
+    def test_rule_compiles_with_dependencies(self):
+        compiled = Rule.objects.get(name='Dataset Language').rule()
+        self.assertEqual(compiled.type, 'ConditionalRule')
+        self.assertEqual(compiled.requirement.name, 'Language is Valid')
+
+class JobQueueTest(TestCase):
+    def setUp(self):
+        ruleset = RuleSet.objects.create(name='Test Rules', purpose='Testing')
+        self.job = ValidationJob.objects.create(name='Test Record', ruleset=ruleset, url='http://example.com/record.xml')
+        
+    def test_enqueue_and_claim(self):
+        self.assertEqual(jobqueue.claim_next('test'), None)
+        self.job.enqueue()
+        
+        claimed = jobqueue.claim_next('test')
+        self.assertEqual(claimed.pk, self.job.pk)
+        self.assertEqual(claimed.status, 'running')
+        self.assertEqual(claimed.worker, 'test')
+        
+        # Nobody else can claim it
+        self.assertEqual(jobqueue.claim_next('other'), None)
+        
+    def test_edit_during_run_survives(self):
+        self.job.url = ''
+        self.job.enqueue()
+        claimed = jobqueue.claim_next('test')
+        
+        # Edited and queued again in the admin while the worker runs the old copy
+        job = ValidationJob.objects.get(pk=self.job.pk)
+        job.url = 'http://example.com/edited.xml'
+        job.enqueue()
+        jobqueue.run(claimed)
+        
+        job = ValidationJob.objects.get(pk=self.job.pk)
+        self.assertEqual(job.url, 'http://example.com/edited.xml')
+        self.assertEqual(job.status, 'queued')
+        self.assertEqual(job.last_result, False)
+
+class PackedReportTest(TestCase):
+    def test_pack_round_trip(self):
+        items = ['Metadata: Has File Identifier', 'Metadata: Language Code is Valid', u'Caf\xe9 is not a valid URL']
+        packed = pack_items(items)
+        self.assertEqual(unpack_items(packed), items)
+        
+    def test_packed_is_compact(self):
+        items = ['IdentificationInfo: CI_Citation RoleCode codeList is valid'] * 50
+        self.assertTrue(len(pack_items(items)) < len(''.join(items)) / 10)
+
+GETRECORDS_PAGE = """<?xml version="1.0"?>
+<csw:GetRecordsResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2" xmlns:dc="http://purl.org/dc/elements/1.1/">
+  <csw:SearchResults numberOfRecordsMatched="3" numberOfRecordsReturned="%(returned)s" nextRecord="%(next)s">
+    %(records)s
+  </csw:SearchResults>
+</csw:GetRecordsResponse>"""
+
+def getrecords_page(ids, next_record):
+    records = ''.join(['<csw:BriefRecord><dc:identifier>%s</dc:identifier></csw:BriefRecord>' % id for id in ids])
+    return GETRECORDS_PAGE % {'returned': len(ids), 'next': next_record, 'records': records}
+
+class CswHarvestTest(TestCase):
+    url = 'http://example.com/csw?request=GetRecords&service=CSW&maxRecords=2'
+    
+    def test_page_url(self):
+        self.assertEqual(page_url(self.url + '&startPosition=1', 3), 
+                         'http://example.com/csw?request=GetRecords&service=CSW&maxRecords=2&startPosition=3')
+        
+    def test_follows_next_record(self):
+        requested = list()
+        def open_url(url):
+            requested.append(url)
+            return StringIO(getrecords_page(['c'], 0))
+        
+        files = list(files_from_csw(self.url, getrecords_page(['a', 'b'], 3), open_url))
+        self.assertEqual(requested, [page_url(self.url, 3)])
+        self.assertEqual(len(files), 3)
+        self.assertTrue(files[2][0].endswith('Id=c&elementSetName=full&outputSchema=http://www.isotc211.org/2005/gmd'))
+        
+    def test_no_records(self):
+        files = list(files_from_csw(self.url, getrecords_page([], 0)))
+        self.assertEqual(files, [('', 'No csw:BriefRecord elements found in csw:GetRecordsResponse.')])
+
+    def test_streamed_first_page(self):
+        page = getrecords_page(['a', 'b'], 0)
+        released = list()
+        stream = StreamingResponse(self.url, 200, {'content-encoding': 'gzip'}, StringIO(gzip_bytes(page)), released.append)
+        stream.CHUNK_SIZE = 16
+        
+        tag, prefix = sniff_root(stream, 64)
+        self.assertEqual(tag, '{http://www.opengis.net/cat/csw/2.0.2}GetRecordsResponse')
+        self.assertTrue(len(prefix) < len(page))
+        
+        files = list(files_from_csw(self.url, ReplayStream(prefix, stream)))
+        self.assertEqual(len(files), 2)
+        self.assertEqual(released, [True])
+
+def gzip_bytes(content):
+    buffer = StringIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as file:
+        file.write(content)
+    return buffer.getvalue()
+
+class WafCrawlTest(TestCase):
+    pages = {'http://example.com/metadata/': '<a href="../">Parent</a><a href="?C=N;O=D">Name</a><a href="a/">a/</a><a href="1.xml">1.xml</a>',
+             'http://example.com/metadata/a/': '<a href="/metadata/">Parent</a><a href="b/">b/</a><a href="2.xml">2.xml</a><a href="../1.xml">1.xml</a>',
+             'http://example.com/metadata/a/b/': '<a href="3.xml">3.xml</a>'}
+    
+    def test_crawl_follows_subfolders_once(self):
+        files = list(crawl_waf('http://example.com/metadata/', open_url=self.pages.get))
+        self.assertEqual(files, [('http://example.com/metadata/1.xml', ''),
+                                 ('http://example.com/metadata/a/2.xml', ''),
+                                 ('http://example.com/metadata/a/b/3.xml', '')])
+        
+    def test_crawl_depth_limit(self):
+        files = list(crawl_waf('http://example.com/metadata/', max_depth=1, open_url=self.pages.get))
+        self.assertEqual(len(files), 2)
+
+AUTOINDEX = '''<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">
+<html><head><title>Index of /metadata</title></head><body>
+<h1>Index of /metadata</h1>
+<table><tr><th><a href="?C=N;O=D">Name</a></th><th><a href="?C=M;O=A">Last modified</a></th></tr>
+<tr><td><a href="/">Parent Directory</a></td></tr>
+<tr><td><a href="dataset-1.xml">dataset-1.xml</a></td><td>2011-03-01 10:00</td></tr>
+<tr><td><a href="dataset-2.XML.xml">dataset-2.XML.xml</a></td><td>2011-03-01 10:00</td></tr>
+<tr><td><a href="readme.txt">readme.txt</a></td><td>2011-03-01 10:00</td></tr>
+<tr><td><a href="archive/">archive/</a></td><td>2011-03-01 10:00</td></tr>
+<tr><td><a href="http://example.org/other/dataset-3.xml">dataset-3.xml</a></td><td>2011-03-01 10:00</td></tr>
+</table><address>Apache Server at example.com Port 80</address>
+</body></html>'''
+
+class WafLinksTest(TestCase):
+    url = 'http://example.com/metadata/'
+    
+    def test_parsers_agree(self):
+        # Small chunks, so that tags are split across feeds
+        links = list(links_from_waf(AUTOINDEX, self.url, chunk_size=16))
+        self.assertEqual(links, ['http://example.com/metadata/dataset-1.xml', 'http://example.com/metadata/dataset-2.XML.xml',
+                                 'http://example.org/other/dataset-3.xml'])
+        self.assertEqual(links_from_waf_soup(AUTOINDEX, self.url), links)
+        self.assertEqual(list(links_from_waf(AUTOINDEX, self.url, FOLDER_HREF)), ['http://example.com/metadata/archive/'])
+        self.assertEqual(links_from_waf_soup(AUTOINDEX, self.url, FOLDER_HREF), ['http://example.com/metadata/archive/'])
+        
+    def test_chunk_inside_doctype(self):
+        # Splitting the DOCTYPE declaration between chunks used to crash libxml2
+        for chunk_size in [10, 20, 50]:
+            self.assertEqual(len(list(links_from_waf(AUTOINDEX, self.url, chunk_size=chunk_size))), 3)
+        
+    def test_soup_fallback(self):
+        def failing(response_string, url, pattern):
+            yield 'http://example.com/metadata/dataset-1.xml'
+            raise etree.LxmlError('Broken page')
+        
+        original = harvest.links_from_waf
+        harvest.links_from_waf = failing
+        try:
+            links = list(waf_links(AUTOINDEX, self.url))
+        finally:
+            harvest.links_from_waf = original
+        self.assertEqual(links, ['http://example.com/metadata/dataset-1.xml', 'http://example.com/metadata/dataset-2.XML.xml',
+                                 'http://example.org/other/dataset-3.xml'])
+
+RECORD = """<?xml version="1.0"?>
+<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd" xmlns:gco="http://www.isotc211.org/2005/gco">
+  <gmd:language><gco:CharacterString>%(language)s</gco:CharacterString></gmd:language>
+  <gmd:identificationInfo><gmd:MD_DataIdentification/></gmd:identificationInfo>
+</gmd:MD_Metadata>"""
+
+class ValidateTest(RuleGraphTest):
+    def test_valid_record(self):
+        result, report = self.ruleset.xml_validate(RECORD % {'language': 'eng'})
+        self.assertTrue(result)
+        self.assertEqual(report, [])
+        
+    def test_invalid_record(self):
+        result, report = self.ruleset.xml_validate(RECORD % {'language': 'xyz'})
+        self.assertFalse(result)
+        self.assertEqual(sorted(report), ['Dataset Language: Datasets need a valid language', 
+                                          'Language is Valid: Language code is valid'])
+        
+    def test_unparseable_record(self):
+        self.assertRaises(ValidationException, self.ruleset.xml_validate, '<gmd:MD_Metadata>')
+        
+    def test_rules_run_once_per_record(self):
+        record = parse_record(RECORD % {'language': 'eng'})
+        self.ruleset.compiled_rules().validate(record)
+        # Language is Valid is both a member of the set and the requirement of Dataset Language
+        self.assertEqual(sorted(rule.name for rule in record.outcomes), ['Dataset Language', 'Is a Dataset', 'Language is Valid'])
+        
+    def test_conditional_cycle(self):
+        exists = Rule.objects.get(name='Is a Dataset')
+        first = Rule.objects.create(name='First', description='First', type='ConditionalRule', condition_rule=exists)
+        second = Rule.objects.create(name='Second', description='Second', type='ConditionalRule', 
+                                     condition_rule=exists, requirement_rule=first)
+        first.requirement_rule = second
+        first.save()
+        RuleToRuleSetLink.objects.create(ruleset=self.ruleset, rule=first)
+        
+        ruleset = RuleSet.objects.get(pk=self.ruleset.pk)
+        self.assertRaises(ValidationException, ruleset.compiled_rules)
+        
+    def test_fail_fast(self):
+        link = Rule.objects.create(name='A Link Works', description='Online resource resolves', type='ValidUrlRule')
+        XPath.objects.create(xpath='//gmd:MD_Metadata/gmd:language/gco:CharacterString', rule=link)
+        RuleToRuleSetLink.objects.create(ruleset=self.ruleset, rule=link)
+        ruleset = RuleSet.objects.get(pk=self.ruleset.pk)
+        
+        result, report = ruleset.xml_validate(RECORD % {'language': 'http://127.0.0.1:1/xyz'}, fail_fast=True)
+        self.assertFalse(result)
+        self.assertEqual(len(report), 1)
+        # The network check is the most expensive rule, so it never ran
+        rules = dict((rule.name, rule) for rule in ruleset.rule_list())
+        self.assertEqual(rules['A Link Works'].evaluations, 0)
+        self.assertTrue(rules['A Link Works'].cost() > rules['Language is Valid'].cost())
+        
+        self.assertEqual(ruleset.xml_validate(RECORD % {'language': 'eng'}, fail_fast=True), (False, ['A Link Works: Online resource resolves']))
+        
+    def test_validate_many(self):
+        sources = [RECORD % {'language': language} for language in ['eng', 'xyz', 'spa']] + ['<gmd:MD_Metadata>']
+        for backend in ['threads', 'processes']:
+            results = dict((source, (result, report)) for source, result, report in 
+                           self.ruleset.xml_validate_many(sources, workers=2, backend=backend))
+            self.assertEqual(len(results), 4)
+            self.assertEqual(results[sources[0]], (True, []))
+            self.assertFalse(results[sources[1]][0])
+            self.assertEqual(results[sources[2]], (True, []))
+            self.assertTrue(results[sources[3]][1][0].startswith('Validation Error: '))
+
+class StubClient(object):
+    '''
+    Stands in for the shared HttpClient, answering every request with the next of the given responses
+    '''
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = list()
+        
+    def get(self, url, headers=None):
+        self.requests.append((url, dict(headers or {})))
+        status, content, headers = self.responses.pop(0)
+        return Response(url, status, headers, content)
+
+class TestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep connections alive between requests
+    protocol_version = 'HTTP/1.1'
+    body = '<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd"/>'
+    
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        headers = dict()
+        if self.path == '/moved':
+            status, content, headers = 302, '', {'Location': '/record.xml'}
+        elif self.path == '/flaky' and self.server.paths.count('/flaky') <= 2:
+            status, content = 503, 'Try again'
+        elif self.path == '/gzip':
+            status, content, headers = 200, gzip_bytes(self.body), {'Content-Encoding': 'gzip'}
+        elif self.path == '/deflate':
+            status, content, headers = 200, zlib.compress(self.body), {'Content-Encoding': 'deflate'}
+        elif self.path == '/raw-deflate':
+            status, content, headers = 200, zlib.compress(self.body)[2:-4], {'Content-Encoding': 'deflate'}
+        else:
+            status, content = 200, self.body
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+        
+    def log_message(self, format, *args):
+        pass
+
+class TestServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class HttpClientTest(TestCase):
+    def setUp(self):
+        self.server = TestServer(('127.0.0.1', 0), TestHandler)
+        self.server.paths = list()
+        threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05}).start()
+        self.root = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.client = HttpClient(timeout=5, retries=2, backoff=0.05)
+        
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        
+    def test_connections_are_reused(self):
+        for index in range(3):
+            self.assertEqual(self.client.get(self.root + '/record.xml').content, TestHandler.body)
+        self.assertEqual(self.client.stats(), {'requests': 3, 'connections_opened': 1, 'connections_reused': 2})
+        
+        # A streamed response read to the end gives its connection back too
+        response = self.client.open(self.root + '/record.xml')
+        self.assertEqual(response.read(), TestHandler.body)
+        self.assertEqual(self.client.stats()['connections_reused'], 3)
+        self.assertEqual(self.client.get(self.root + '/record.xml').status, 200)
+        self.assertEqual(self.client.stats()['connections_opened'], 1)
+        
+    def test_server_errors_are_retried(self):
+        start = time.time()
+        response = self.client.get(self.root + '/flaky')
+        self.assertEqual((response.status, response.content), (200, TestHandler.body))
+        self.assertEqual(self.server.paths, ['/flaky'] * 3)
+        # Waits of 0.05 and then 0.1 seconds between the attempts
+        self.assertTrue(time.time() - start >= 0.15)
+        
+    def test_redirects_are_followed(self):
+        response = self.client.get(self.root + '/moved')
+        self.assertEqual((response.url, response.status, response.content), (self.root + '/record.xml', 200, TestHandler.body))
+        self.assertEqual(self.server.paths, ['/moved', '/record.xml'])
+        
+    def test_encoded_responses(self):
+        for path in ['/gzip', '/deflate', '/raw-deflate']:
+            self.assertEqual(self.client.get(self.root + path).content, TestHandler.body)
+            self.assertEqual(self.client.open(self.root + path).read(), TestHandler.body)
+        
+    def test_errors(self):
+        self.assertRaises(HttpError, self.client.get, 'ftp://example.com/record.xml')
+        self.assertRaises(HttpError, self.client.get, 'http://127.0.0.1:1/record.xml')
+
+class ConditionalFetchTest(RuleGraphTest):
+    url = 'http://example.com/metadata/a.xml'
+    
+    def setUp(self):
+        RuleGraphTest.setUp(self)
+        self.job = ValidationJob.objects.create(name='a.xml', ruleset=self.ruleset, url=self.url)
+        self.record = RECORD % {'language': 'eng'}
+        
+    def tearDown(self):
+        discard_default_client()
+        
+    def run_job(self, *responses):
+        client = httpclient._default_client = StubClient(*responses)
+        run_validation_job(ValidationJob.objects.get(pk=self.job.pk))
+        return client.requests[0][1]
+        
+    def report_count(self):
+        return self.job.validationreport_set.count()
+        
+    def test_unchanged_records_are_skipped(self):
+        headers = self.run_job((200, self.record, {'etag': '"1"', 'last-modified': 'Tue, 01 Mar 2011 00:00:00 GMT'}))
+        self.assertEqual(headers, dict())
+        self.assertEqual(self.report_count(), 1)
+        job = ValidationJob.objects.get(pk=self.job.pk)
+        self.assertEqual((job.etag, job.last_modified, job.content_hash), ('"1"', 'Tue, 01 Mar 2011 00:00:00 GMT', sha1(self.record)))
+        
+        # Not Modified
+        headers = self.run_job((304, '', {}))
+        self.assertEqual(headers, {'If-None-Match': '"1"', 'If-Modified-Since': 'Tue, 01 Mar 2011 00:00:00 GMT'})
+        self.assertEqual(self.report_count(), 1)
+        
+        # The same content again from a server that ignores the validators
+        self.run_job((200, self.record, {}))
+        self.assertEqual(self.report_count(), 1)
+        
+    def test_rule_changes_force_validation(self):
+        self.run_job((200, self.record, {'etag': '"1"'}))
+        RuleSet.objects.filter(pk=self.ruleset.pk).update(version=F('version') + 1)
+        
+        # No conditional request, and a new report even though the record is the same
+        headers = self.run_job((200, self.record, {'etag': '"1"'}))
+        self.assertEqual(headers, dict())
+        self.assertEqual(self.report_count(), 2)
+        job = ValidationJob.objects.get(pk=self.job.pk)
+        self.assertEqual(job.ruleset_signature, ruleset_signature([RuleSet.objects.get(pk=self.ruleset.pk)]))
+
+class LocalValidationTest(RuleGraphTest):
+    def setUp(self):
+        RuleGraphTest.setUp(self)
+        self.folder = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.folder, 'sub'))
+        for name, language in [('a.xml', 'eng'), ('sub/b.xml', 'xyz')]:
+            with open(os.path.join(self.folder, name), 'wb') as record:
+                record.write(RECORD % {'language': language})
+        with open(os.path.join(self.folder, 'notes.txt'), 'wb') as notes:
+            notes.write('Not a record')
+        
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        
+    def test_local_sources(self):
+        names = [name for name, source in local_sources(self.folder)]
+        self.assertEqual(names, [os.path.join(self.folder, 'a.xml'), os.path.join(self.folder, 'sub', 'b.xml')])
+        
+        archive_path = os.path.join(self.folder, 'records.zip')
+        archive = zipfile.ZipFile(archive_path, 'w')
+        archive.write(os.path.join(self.folder, 'a.xml'), 'a.xml')
+        archive.close()
+        self.assertEqual(list(local_sources(archive_path)), [(archive_path + '/a.xml', RECORD % {'language': 'eng'})])
+        
+        archive_path = os.path.join(self.folder, 'records.tar.gz')
+        archive = tarfile.open(archive_path, 'w:gz')
+        archive.add(os.path.join(self.folder, 'sub'), 'sub')
+        archive.close()
+        self.assertEqual(list(local_sources(archive_path)), [(archive_path + '/sub/b.xml', RECORD % {'language': 'xyz'})])
+        
+    def test_validate_command(self):
+        output = os.path.join(self.folder, 'results.jsonl')
+        call_command('usginvalid_validate', str(self.ruleset.pk), os.path.join(self.folder, '*.xml'),
+                     processes=2, output=output, save='Local Records', stderr=StringIO())
+        
+        results = [json.loads(line) for line in open(output)]
+        self.assertEqual(results, [{'source': os.path.join(self.folder, 'a.xml'), 'passed': True, 'report': []}])
+        saved = ValidationSet.objects.get(name='Local Records')
+        self.assertEqual(saved.status, 'done')
+        self.assertEqual([job.last_result for job in saved.validationjob_set.all()], [True])
+        
+    def test_validate_command_failure(self):
+        # Conditional rules that depend on each other cannot be compiled
+        first = Rule.objects.create(name='First', description='First', type='ConditionalRule')
+        second = Rule.objects.create(name='Second', description='Second', type='ConditionalRule', 
+                                     condition_rule=first, requirement_rule=first)
+        Rule.objects.filter(pk=first.pk).update(condition_rule=second, requirement_rule=second)
+        RuleToRuleSetLink.objects.create(ruleset=self.ruleset, rule=first)
+        
+        self.assertRaises(ValidationException, call_command, 'usginvalid_validate', str(self.ruleset.pk), 
+                          os.path.join(self.folder, '*.xml'), processes=1, output=os.path.join(self.folder, 'results.jsonl'), 
+                          save='Broken', stderr=StringIO())
+        saved = ValidationSet.objects.get(name='Broken')
+        self.assertEqual(saved.status, 'failed')
+        self.assertNotEqual(saved.status_message, '')
+
+class SetResultsViewTest(TestCase):
+    urls = 'usginvalid.urls'
+    
+    def setUp(self):
+        ruleset = RuleSet.objects.create(name='Test Rules', purpose='Testing')
+        self.set = ValidationSet.objects.create(name='Test Set', ruleset=ruleset, url='http://example.com/metadata/')
+        for name, result, reports in [('a.xml', True, [[]]), ('b.xml', False, [['Old problem'], ['New problem']]), ('c.xml', False, [])]:
+            job = ValidationJob.objects.create(name=name, ruleset=ruleset, url='http://example.com/metadata/' + name, 
+                                               set=self.set, last_result=result)
+            for report in reports:
+                save_report(job, result, report)
+        
+    def test_streams_latest_results(self):
+        response = self.client.get('/set/%d/results/' % self.set.pk)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.content.splitlines()]
+        self.assertEqual([(line['name'], line['passed'], line['report']) for line in lines],
+                         [('a.xml', True, ['Passed Validation Without Errors']), ('b.xml', False, ['New problem']),
+                          ('c.xml', False, [])])
+        
+    def test_latest_report(self):
+        job = ValidationJob.objects.get(name='b.xml')
+        reports = list(job.validationreport_set.all())
+        self.assertEqual(job.latest_report_id, reports[1].pk)
+        
+        reports[1].delete()
+        self.assertEqual(ValidationJob.objects.get(pk=job.pk).latest_report_id, reports[0].pk)
+        
+        jobs = list(ValidationJob.objects.select_related('latest_report'))
+        self.assertNumQueries(0, lambda: [job.last_report_link() for job in jobs])
+        
+    def test_delete_set(self):
+        # Reports deleted along with their jobs do not each refresh the job
+        connection.use_debug_cursor = True
+        try:
+            del connection.queries[:]
+            self.set.delete()
+            refreshes = [query for query in connection.queries if query['sql'].startswith('UPDATE') and 'MAX(' in query['sql']]
+        finally:
+            connection.use_debug_cursor = None
+        self.assertEqual(refreshes, [])
+        self.assertEqual(ValidationJob.objects.filter(name__in=['a.xml', 'b.xml', 'c.xml']).count(), 0)
+
+class SaveSetResultsTest(TestCase):
+    def setUp(self):
+        self.ruleset = RuleSet.objects.create(name='Test Rules', purpose='Testing')
+        self.set = ValidationSet.objects.create(name='Test Set', ruleset=self.ruleset, url='http://example.com/metadata/')
+        ValidationJob.objects.create(name='http://example.com/metadata/a.xml', url='http://example.com/metadata/a.xml',
+                                     ruleset=self.ruleset, set=self.set, last_result=False)
+        
+    def test_bulk_upsert(self):
+        jobs = dict((job.name, job) for job in self.set.validationjob_set.all())
+        batch = [RecordOutcome(('http://example.com/metadata/%s.xml' % name, ''), [(self.ruleset, result, report)]) 
+                 for name, result, report in [('a', True, []), ('b', False, ['Missing title']), ('c', True, [])]]
+        
+        # Job inserts and reading them back, job updates, then the last report key, report inserts and reading
+        # them back, their items and latest_report
+        self.assertNumQueries(8, lambda: save_set_results(self.set, batch, jobs, [self.ruleset]))
+        self.assertEqual(sorted(jobs.keys()), ['http://example.com/metadata/%s.xml' % name for name in 'abc'])
+        
+        saved = dict((job.name[-5:], job) for job in self.set.validationjob_set.select_related('latest_report'))
+        self.assertEqual(len(saved), 3)
+        self.assertEqual([saved[name].last_result for name in ['a.xml', 'b.xml', 'c.xml']], [True, False, True])
+        self.assertEqual(saved['b.xml'].latest_report.items(), ['Missing title'])
+        self.assertEqual(saved['a.xml'].ruleset_version, self.ruleset.version)
+        
+    def test_reports_in_one_insert(self):
+        jobs = list(self.set.validationjob_set.all()) * 3
+        results = [(job, self.ruleset, False, ['Problem %d' % index, 'Other']) for index, job in enumerate(jobs)]
+        with self.assertNumQueries(5):
+            reports = save_reports(results)
+        self.assertEqual([report.items() for report in reports], [['Problem %d' % index, 'Other'] for index in range(3)])
+        self.assertEqual(ValidationJob.objects.get(pk=jobs[0].pk).latest_report_id, reports[2].pk)
+
+class LinkCheckTest(TestCase):
+    def setUp(self):
+        self.checker = LinkChecker(workers=2)
+        
+    def tearDown(self):
+        self.checker.close()
+        
+    def test_results_are_stored(self):
+        self.assertEqual(self.checker.check_all(['ftp://example.com/a', 'ftp://example.com/a']), {'ftp://example.com/a': False})
+        stored = LinkCheckResult.objects.get(url_hash=url_hash('ftp://example.com/a'))
+        self.assertFalse(stored.passed)
+        self.assertEqual(stored.message, 'Unsupported URL scheme: ftp://example.com/a')
+        
+    def test_stored_results_are_reused(self):
+        # Nothing is listening here, so a True result can only come from the table
+        url = 'http://127.0.0.1:1/license.html'
+        LinkCheckResult.objects.create(url=url, url_hash=url_hash(url), passed=True, status=200)
+        self.assertTrue(self.checker.check(url))
+        
+        LinkCheckResult.objects.all().update(checked_at=datetime.datetime.now() - datetime.timedelta(days=2))
+        self.checker.known.clear()
+        self.assertEqual(self.checker.remembered([url]), dict())
+        
+    def test_stored_results_keep_their_age(self):
+        url = 'http://127.0.0.1:1/license.html'
+        LinkCheckResult.objects.create(url=url, url_hash=url_hash(url), passed=True, status=200)
+        LinkCheckResult.objects.all().update(checked_at=datetime.datetime.now() - datetime.timedelta(hours=23))
+        self.assertEqual(self.checker.remembered([url]), {url: True})
+        self.assertTrue(time.time() - self.checker.known[url][1] > 22 * 3600)
+
+class RecordCacheTest(TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = RecordCache(self.folder, max_bytes=350)
+        
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        
+    def test_put_and_get(self):
+        self.assertEqual(self.cache.get('http://example.com/a.xml'), None)
+        self.cache.put('http://example.com/a.xml', '<a/>', etag='"1"')
+        entry = self.cache.get('http://example.com/a.xml')
+        self.assertEqual((entry.etag, self.cache.content(entry)), ('"1"', '<a/>'))
+        
+        record = fetch_record('http://example.com/a.xml', cache=self.cache, cache_only=True)
+        self.assertEqual((record.content, record.etag), ('<a/>', '"1"'))
+        self.assertRaises(IOError, fetch_record, 'http://example.com/b.xml', cache=self.cache, cache_only=True)
+        
+    def test_least_recently_used_are_evicted(self):
+        for name in 'abc':
+            self.cache.put('http://example.com/%s.xml' % name, name * 100)
+            # Modification times are the measure of use, so keep them apart
+            os.utime(self.cache.path('objects', sha1(name * 100)), (time.time() - 100 + ord(name), time.time() - 100 + ord(name)))
+        self.cache.content(self.cache.get('http://example.com/a.xml'))
+        self.cache.put('http://example.com/d.xml', 'd' * 100)
+        
+        self.assertEqual([name for name in 'abcd' if self.cache.get('http://example.com/%s.xml' % name) is not None], ['a', 'c', 'd'])
+        self.assertEqual(self.cache.size, 300)
+
+class MultipleRuleSetTest(RuleGraphTest):
+    def setUp(self):
+        RuleGraphTest.setUp(self)
+        self.strict = RuleSet.objects.create(name='Strict Rules', purpose='Testing')
+        RuleToRuleSetLink.objects.create(ruleset=self.strict, rule=Rule.objects.get(name='Language is Valid'))
+        RuleToRuleSetLink.objects.create(ruleset=self.strict, rule=Rule.objects.get(name='Is a Dataset'))
+        self.set = ValidationSet.objects.create(name='Test Set', ruleset=self.ruleset, url='http://example.com/metadata/')
+        self.set.extra_rulesets.add(self.strict)
+        
+    def test_shared_rules_run_once(self):
+        rulesets = self.set.rulesets()
+        self.assertEqual([ruleset.name for ruleset in rulesets], ['Test Rules', 'Strict Rules'])
+        
+        record = parse_record(RECORD % {'language': 'xyz'})
+        outcomes = compiled_group(rulesets).validate(record)
+        self.assertEqual(outcomes, [(False, ['Dataset Language: Datasets need a valid language', 'Language is Valid: Language code is valid']),
+                                    (False, ['Language is Valid: Language code is valid'])])
+        self.assertEqual(len(record.outcomes), 3)
+        
+    def test_one_report_per_ruleset(self):
+        rulesets = self.set.rulesets()
+        outcome = RecordOutcome(('http://example.com/metadata/a.xml', ''), [(rulesets[0], True, []), (rulesets[1], False, ['Missing'])])
+        save_set_results(self.set, [outcome], dict(), rulesets)
+        
+        job = self.set.validationjob_set.get()
+        self.assertFalse(job.last_result)
+        self.assertEqual(job.ruleset_signature, ruleset_signature(rulesets))
+        self.assertEqual([(report.ruleset.name, report.passed) for report in job.validationreport_set.order_by('pk')],
+                         [('Test Rules', True), ('Strict Rules', False)])
+        
+    def test_results_per_ruleset(self):
+        rulesets = self.set.rulesets()
+        outcomes = [RecordOutcome(('http://example.com/metadata/%s.xml' % name, ''), [(rulesets[0], True, []), (rulesets[1], False, [name])])
+                    for name in 'abc']
+        save_set_results(self.set, outcomes, dict(), rulesets)
+        
+        # The rule sets, the jobs, the newest report for each rule set, those reports and their items
+        with self.assertNumQueries(5):
+            lines = [json.loads(line) for line in job_results(self.set)]
+        lines.sort(key=lambda line: line['name'])
+        self.assertEqual([[(report['ruleset'], report['report']) for report in line['reports']] for line in lines],
+                         [[('Test Rules', ['Passed Validation Without Errors']), ('Strict Rules', [name])] for name in 'abc'])
+        
+        # Read a page of two jobs at a time
+        views.RESULTS_CHUNK_SIZE = 2
+        try:
+            paged = [json.loads(line) for line in job_results(self.set)]
+        finally:
+            views.RESULTS_CHUNK_SIZE = 500
+        self.assertEqual(sorted(paged, key=lambda line: line['name']), lines)
+
+class SharedPathTest(TestCase):
+    def test_split_steps(self):
+        self.assertEqual(split_steps('//gmd:MD_Metadata/gmd:identificationInfo//gmd:citation/@codeList'),
+                         [('//', 'gmd:MD_Metadata'), ('/', 'gmd:identificationInfo'), ('//', 'gmd:citation'), ('/', '@codeList')])
+        self.assertEqual(split_steps('gmd:individualName'), None)
+        self.assertEqual(split_steps('//gmd:CI_Citation[1]/gmd:title'), None)
+        self.assertEqual(split_steps('//gmd:title | //gmd:abstract'), None)
+
+    def test_wide_steps_are_skipped(self):
+        citation = '<gmd:citation><gmd:CI_Citation><gmd:title>%d</gmd:title></gmd:CI_Citation></gmd:citation>'
+        content = ('<gmd:MD_Metadata xmlns:gmd="http://www.isotc211.org/2005/gmd"><gmd:identificationInfo>%s</gmd:identificationInfo></gmd:MD_Metadata>' % 
+                   ''.join([citation % index for index in range(6)]))
+        compiler = RuleCompiler()
+        title = compiler.select('//gmd:MD_Metadata/gmd:identificationInfo/gmd:citation/gmd:CI_Citation/gmd:title')
+        citations = title.parent.parent
+        
+        first = Record.from_bytes(content)
+        self.assertEqual([node.text for node in title.select(first)], [str(index) for index in range(6)])
+        self.assertTrue(citations.wide)
+        
+        # The next record goes straight past the wide steps without computing their node sets
+        second = Record.from_bytes(content)
+        self.assertEqual([node.text for node in title.select(second)], [str(index) for index in range(6)])
+        self.assertFalse(citations in second.nodesets)
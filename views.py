@@ -2,7 +2,9 @@ from django.shortcuts import get_list_or_404, get_object_or_404, render_to_respo
 from django.template.loader import render_to_string
 from django.http import HttpResponse
 from django.core import serializers
-from models import Rule, RuleToRuleSetLink, RuleSet, ValidValuesSet, ValidValue
+from django.db.models import Max
+from models import Rule, RuleToRuleSetLink, RuleSet, ValidValuesSet, ValidValue, ValidationSet, ValidationReport, report_items
+import json
 
 def rule_view(request, pk):
     rule = get_list_or_404(Rule, pk=pk)
@@ -10,48 +12,47 @@ def rule_view(request, pk):
     return HttpResponse(response, mimetype='application/json')
 
 def serialize_rule(rule):
+    '''
+    Given a RuleNode from a loaded rule graph
+    Returns a dictionary suitable for the ruleset templates
+    '''
     if rule.type in ['ExistsRule', 'ValidUrlRule']:
         result = {'pk': rule.pk, 
                   'name': rule.name,
                   'type': rule.type,
-                  'xpath': rule.xpath_set.all()[0].xpath}
+                  'xpath': rule.xpaths[0]}
     if rule.type == 'ValueInListRule':
         result = {'pk': rule.pk,
                   'name': rule.name,
                   'type': rule.type, 
-                  'xpath': rule.xpath_set.all()[0].xpath,
-                  'values_name': rule.values.name,
-                  'values_pk': rule.values.pk,
-                  'values': list(item.encode('ASCII') for item in rule.values.values_list())}
+                  'xpath': rule.xpaths[0],
+                  'values_name': rule.values_name,
+                  'values_pk': rule.values_pk,
+                  'values': sorted(item.encode('ASCII') for item in rule.values)}
     if rule.type in ['AnyOfRule', 'OneOfRule']:
         result = {'pk': rule.pk,
                   'name': rule.name, 
                   'type': rule.type, 
-                  'xpaths': rule.xpath_set.all(),
+                  'xpaths': list(rule.xpaths),
                   'context': rule.context}
     if rule.type == 'ContentMatchesExpressionRule':
         result = {'pk': rule.pk,
                   'name': rule.name, 
                   'type': rule.type, 
-                  'xpath': rule.xpath_set.all()[0].xpath,
+                  'xpath': rule.xpaths[0],
                   'expression': rule.regex}
     if rule.type == 'ConditionalRule':
         result = {'pk': rule.pk,
                   'name': rule.name, 
                   'type': rule.type,
-                  'condition': serialize_rule(rule.condition_rule),
-                  'requirement': serialize_rule(rule.requirement_rule)}
+                  'condition': serialize_rule(rule.condition),
+                  'requirement': serialize_rule(rule.requirement)}
     return result
-
-def clean_xpaths_list(rule):
-    if 'xpaths' in rule:
-        rule['xpaths'] = list(item.xpath for item in rule['xpaths'])
-    return rule
     
 def ruleset_view(request, pk, format=None):
     ruleset = get_object_or_404(RuleSet, pk=pk)
     rules = list()
-    for rule in ruleset.rules.all():
+    for rule in ruleset.compiled_rules().graph:
         rules.append(serialize_rule(rule))
     
     if format == 'list':
@@ -68,10 +69,7 @@ def ruleset_view(request, pk, format=None):
         result += '\t\tlist.__init__(self)\n\n'
         
         for rule in rules:
-            rule = clean_xpaths_list(rule)
             if rule['type'] == 'ConditionalRule':
-                rule['condition'] = clean_xpaths_list(rule['condition'])
-                rule['requirement'] = clean_xpaths_list(rule['requirement'])
                 result += render_to_string(types[rule['condition']['type']], {'rule': rule['condition'], 'name': 'condition'})
                 result += render_to_string(types[rule['requirement']['type']], {'rule': rule['requirement'], 'name': 'requirement'})
                 
@@ -84,4 +82,51 @@ def ruleset_view(request, pk, format=None):
 def valueset_view(request, pk):
     valueset = get_object_or_404(ValidValuesSet, pk=pk)
     values = get_list_or_404(ValidValue, set=valueset)
-    return render_to_response('usginvalid/valueset.html', {'valueset': valueset, 'values': values})
\ No newline at end of file
+    return render_to_response('usginvalid/valueset.html', {'valueset': valueset, 'values': values})
+
+# Jobs read, and whose reports are read, together
+RESULTS_CHUNK_SIZE = 500
+
+def job_results(validation_set):
+    '''
+    Given a ValidationSet
+    Yields one JSON line per job with its latest result and report. Jobs are read a page at a time by primary
+    key, so memory use does not grow with the size of the set on any database backend. For sets validated
+    against several rule sets, each line also lists the latest report for each of them. Reports and their
+    items are read for a page of jobs at a time, in a fixed number of queries.
+    '''
+    rulesets = validation_set.rulesets()
+    jobs = validation_set.validationjob_set.select_related('latest_report').order_by('pk')
+    last = 0
+    while last is not None:
+        chunk = list(jobs.filter(pk__gt=last)[:RESULTS_CHUNK_SIZE])
+        # A short page is the last one
+        last = chunk[-1].pk if len(chunk) == RESULTS_CHUNK_SIZE else None
+        
+        reports = [job.latest_report for job in chunk if job.latest_report is not None]
+        latest = dict()
+        if len(rulesets) > 1:
+            newest = (ValidationReport.objects.filter(job__in=[job.pk for job in chunk], ruleset__in=[ruleset.pk for ruleset in rulesets])
+                      .values('job', 'ruleset').annotate(newest=Max('pk')))
+            newest = [row['newest'] for row in newest]
+            if len(newest) > 0:
+                for report in ValidationReport.objects.filter(pk__in=newest):
+                    latest[(report.job_id, report.ruleset_id)] = report
+                reports.extend(latest.values())
+        items = report_items(reports)
+        
+        for job in chunk:
+            line = {'job': job.pk, 'name': job.name, 'url': job.url, 'passed': job.last_result, 
+                    'run_date': None, 'report': []}
+            if job.latest_report is not None:
+                line['run_date'] = job.latest_report.run_date.isoformat()
+                line['report'] = items[job.latest_report.pk]
+            if len(rulesets) > 1:
+                line['reports'] = [{'ruleset': ruleset.name, 'passed': latest[(job.pk, ruleset.pk)].passed, 
+                                    'report': items[latest[(job.pk, ruleset.pk)].pk]}
+                                   for ruleset in rulesets if (job.pk, ruleset.pk) in latest]
+            yield json.dumps(line) + '\n'
+
+def set_results_view(request, pk):
+    validation_set = get_object_or_404(ValidationSet, pk=pk)
+    return HttpResponse(job_results(validation_set), mimetype='application/x-ndjson')